@@ -1,9 +1,15 @@
 from fastapi import FastAPI, HTTPException,UploadFile,Form,File
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import google.generativeai as genai
 
 import os
+import asyncio
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import List
 from dotenv import load_dotenv
@@ -14,13 +20,52 @@ import sqlite3
 import pandas as pd
 import json
 
-from db_setup import DatabaseSetup
-from db_profiling import DatabaseProfiler
-from llm_profiling import LLMProfilingSummarizer
+from profiling_pipeline import ProfilingPipeline
+from schema_context import SchemaContextCache
+from catalog import Catalog
+from schema_retrieval import estimate_tokens
+from db_pool import ReadOnlyConnectionPool
+from query_cache import NLToSQLCache
+from result_cache import ResultCache
+from sql_utils import referenced_tables
+from result_compaction import ResultSummarizer, compact_results, format_results_for_prompt
+from job_queue import JobQueue
+from index_advisor import IndexAdvisor
+from rollups import RollupManager
+from backends import create_backend
+from sql_guard import QueryGuard, QueryRejected, QueryTimeout
+from sql_utils import has_limit
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_services()
+    #tables ingested before the duckdb backend was switched on get their parquet copies now
+    #(a fresh install has no ingest db yet, and the read-only pool can't open a missing file)
+    if backend.name != 'sqlite' and os.path.exists(DB_PATH):
+        conn = read_pool.get_connection()
+        stored = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '%__staging'")]
+        missing = [table_name for table_name in stored if table_name not in backend.tables()]
+        if missing:
+            backend.load_tables(DB_PATH, missing)
+    #uploads are ingested by background workers, queued jobs from before a restart resume here
+    ingest_jobs.start()
+    yield
+    ingest_jobs.stop()
+    #release the sql worker threads and their pooled connections on shutdown
+    sql_executor.shutdown(wait=False)
+    backend.close()
+    read_pool.close_all()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(QueryRejected)
+@app.exception_handler(QueryTimeout)
+async def query_guard_error(request, exc):
+    """Rejected (400) and timed out (408) queries come back as structured json"""
+    return JSONResponse(status_code=exc.status_code, content=exc.to_dict())
 class QueryRequest(BaseModel):
     user_query: str
 
@@ -30,55 +75,110 @@ class QueryRequest(BaseModel):
 model = genai.GenerativeModel("gemini-2.5-flash")
 
 UPLOAD_DIR='uploads'
-os.makedirs(UPLOAD_DIR,exist_ok=True)
+CATALOG_DB = 'catalog.db' #summaries, profiles, llm descriptions, pipeline state and schema version of every table
+#legacy json metadata, imported into the catalog the first time it's opened
 SUMMARY_FILE = 'all_summaries.json'
 PROFILE_FILE= 'all_profiles101.json'
 LLM_PROFILE_DIR='separate_llm_profiles/' #contains all separate llm profile jsons
 COMPLETE_SUMMARY_FILE = 'complete_profiles.json' #this one has the llm profiling with everything else as well
+DB_PATH = 'cloud_costs.db'
+PIPELINE_STATE_FILE = 'pipeline_state.json' #input/output fingerprints of every pipeline stage per table
+UPLOAD_CHUNK_BYTES = 1024 * 1024 #uploads are written to disk this many bytes at a time
+JOBS_DB = 'jobs.db' #queued/running/finished ingest jobs
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", 1)) #background threads running ingest jobs
+QUERY_CACHE_DB = 'query_cache.db' #normalized question + schema version -> generated sql
+SCHEMA_TOP_K_TABLES = int(os.getenv("SCHEMA_TOP_K_TABLES", 3)) #tables kept in the prompt per query (0 keeps all)
+SCHEMA_TOP_K_COLUMNS = int(os.getenv("SCHEMA_TOP_K_COLUMNS", 30)) #columns kept per table (0 keeps all)
+ANSWER_RESULT_BUDGET_BYTES = int(os.getenv("ANSWER_RESULT_BUDGET_BYTES", 16000)) #results larger than this are summarized for the answer prompt
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", 500)) #rows per chunk in /text_to_sql/stream
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", 50000)) #csv rows held in memory at once during ingest
+PROFILE_WORKERS = int(os.getenv("PROFILE_WORKERS", os.cpu_count() or 1)) #processes computing column statistics
+APPROX_PROFILE_ROWS = int(os.getenv("APPROX_PROFILE_ROWS", 5000000)) #larger tables get the single-pass approximate profile
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", 256 * 1024 * 1024)) #memory budget for cached sql results
+
+#per-stage concurrency limits for /text_to_sql
+SQL_GENERATION_CONCURRENCY = int(os.getenv("SQL_GENERATION_CONCURRENCY", 8)) #llm calls writing the sql
+SQL_EXECUTION_WORKERS = int(os.getenv("SQL_EXECUTION_WORKERS", 4)) #threads running the sql
+ANSWER_CONCURRENCY = int(os.getenv("ANSWER_CONCURRENCY", 8)) #llm calls writing the answer
+#llm profiling of uploaded tables
+LLM_PROFILING_CONCURRENCY = int(os.getenv("LLM_PROFILING_CONCURRENCY", 4)) #tables described at once
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 60)) #match the gemini quota
+LLM_BATCH_COLUMNS = int(os.getenv("LLM_BATCH_COLUMNS", 25)) #columns described per llm request
+COLUMN_DESCRIPTION_CACHE = 'column_descriptions.json' #legacy table.column + statistics fingerprint -> descriptions
+QUERY_LOG_DB = 'query_log.db' #every executed sql with its run count and latency, read by the index advisor
+INDEX_DISK_BUDGET_BYTES = int(os.getenv("INDEX_DISK_BUDGET_BYTES", 512 * 1024 * 1024)) #total size of the automatic indexes
+EXECUTION_BACKEND = os.getenv("EXECUTION_BACKEND", "sqlite") #'sqlite' or 'duckdb' (columnar, over parquet exports of the tables)
+PARQUET_DIR = 'parquet' #parquet copies of the ingested tables read by the duckdb backend
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", 10000)) #LIMIT added to generated sql that has none (0 disables it)
+STREAM_MAX_ROWS = int(os.getenv("STREAM_MAX_ROWS", 1000000)) #same for /text_to_sql/stream
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", 30)) #generated sql is interrupted after this long
+MAX_CROSS_JOIN_ROWS = int(os.getenv("MAX_CROSS_JOIN_ROWS", 10000000)) #nested full scans multiplying past this are rejected
 
 
 #------ for the main api--------
+#generated sql must be a single read-only statement, gets a row cap and runs under a deadline
+query_guard = QueryGuard(max_rows=QUERY_MAX_ROWS, timeout_seconds=QUERY_TIMEOUT_SECONDS,
+                         max_cross_join_rows=MAX_CROSS_JOIN_ROWS)
+#the sql stage runs on its own threads so the event loop never blocks on sqlite (they start on first use)
+sql_executor = ThreadPoolExecutor(max_workers=SQL_EXECUTION_WORKERS, thread_name_prefix='sql')
+sql_generation_limit = asyncio.Semaphore(SQL_GENERATION_CONCURRENCY)
+answer_limit = asyncio.Semaphore(ANSWER_CONCURRENCY)
+result_cache = ResultCache(RESULT_CACHE_BYTES)
+
+#everything that opens a database or touches the disk is created by `setup_services` on startup:
+#spawned profiling workers re-import the main module, and importing api.py must not do any of that
+read_pool = None #one read-only connection per worker thread, reused across requests
+backend = None #engine the generated sql runs on
+sql_cache = None
+index_advisor = None
+catalog = None
+schema_cache = None
+rollups = None
+pipeline = None
+ingest_jobs = None
+
 def get_profile_descriptions():
     """
     Gets complete profile descriptions.
 
-    Args:
-        - user_query
-
     Return:
-        - profile map
+        - profile map (served from the schema context cache)
     """
-    #opens the file that has the profiles saved
-    with open('complete_profiles.json','r') as f:
-        all_profiles = json.load(f)
-    print(all_profiles)
-    
-    #only uses the short descriptions for the data
-    profile_map = {}
-    for table in all_profiles.keys():
-        profile_map[table] = {
-            'row_count': all_profiles[table]['row_count'],
-            'columns': {col: {
-                'data_type': data['data_type'],
-                'sample_values': data['sample_values'][:2],
-                'short_description': data['short_description']
-                # 'long_description':data['long_description'],
-            } for col, data in all_profiles[table]['columns'].items()}
-        }
-    return profile_map
+    return schema_cache.get().profile_map
+
+def log_query(query: str, elapsed_ms: float = None):
+    """Logs an executed query for the index advisor, which only indexes the sqlite db"""
+    if backend.name == 'sqlite':
+        index_advisor.record(query, elapsed_ms)
 
 def execute_sql_query(query: str):
     """
-    Connects to the database and performs the sql query, closes the db and returns the result in a list of rows.
+    Performs the sql query on the execution backend (for sqlite this thread's pooled read-only connection)
+    and returns the result in a list of rows.
+    The query goes through the guard first (read-only, row cap, plan check and deadline).
+    The result is cached until one of the tables it reads is rewritten.
     """
-    print(f"EXECUTING SQL: {query}")
-    #what i cant do is connect to the db for every execution of the sql query (im not5 sure if thats fine)
-    conn = sqlite3.connect('cloud_costs.db')
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df.to_dict('records')
+    query = query_guard.prepare(query)
+    cache_key = result_cache.make_key(query, referenced_tables(query, backend.tables()))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        log_query(query)
+        return cached
 
-def generate_sql_from_natural_language(user_query: str):
+    print(f"EXECUTING SQL: {query}")
+    start = time.perf_counter()
+    df = backend.read_frame(query)
+    log_query(query, (time.perf_counter() - start) * 1000)
+    records = df.to_dict('records')
+    result_cache.put(cache_key, records)
+    return records
+
+async def run_sql_query(query: str):
+    """Runs `execute_sql_query` on the sql thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sql_executor, execute_sql_query, query)
+
+async def generate_sql_from_natural_language(user_query: str):
     """
     Creates the sql query by querying the llm.
 
@@ -88,36 +188,43 @@ def generate_sql_from_natural_language(user_query: str):
     Returns:
         - sql_query
     """
-    #gets profile dict
-    profile_map = get_profile_descriptions()
-    schema_context = ""
-    for table_name, profile in profile_map.items():
-        schema_context += f"\nTable: {table_name}\nRows: {profile['row_count']}\n"
-        for col_name, col_data in profile['columns'].items():
-            schema_context += f"  - {col_name}: {col_data['short_description']}\n"
+    schema = schema_cache.get()
+    #the same (normalized) question against the same schema reuses the sql from last time
+    cached_sql = sql_cache.get(user_query, schema.version)
+    if cached_sql is not None:
+        return cached_sql
+
+    #the schema context is prebuilt, the query only selects the relevant part of it
+    prompt = schema.build_prompt(user_query)
+    print(f"Schema prompt: {estimate_tokens(prompt)} of {schema.full_prompt_tokens} tokens")
     
-    prompt = f"""Database Schema:
-{schema_context}
-
-Query: "{user_query}"
-
-Return ONLY SQL:"""
-    
-    response = model.generate_content(prompt)
+    async with sql_generation_limit:
+        response = await model.generate_content_async(prompt)
     sql_query = response.text.strip().replace('```sql', '').replace('```', '').strip()
+    sql_cache.put(user_query, schema.version, sql_query,
+                  referenced_tables(sql_query, list(schema.profile_map) + list(schema.rollups)))
     return sql_query
 
-def generate_natural_language_answer(user_query: str, sql_results: list, sql_query: str):
-    if not sql_results:
-        return "No data found."
-    
-    prompt = f"""Query: {user_query}
+def build_answer_prompt(user_query: str, sql_results, sql_query: str, compacted: bool = False):
+    """
+    Prompt for the natural language answer. `sql_results` is either the rows themselves
+    or (when `compacted`) the summary from `compact_results`.
+    """
+    return f"""Query: {user_query}
 SQL: {sql_query}
-Results: {sql_results}
+Results: {format_results_for_prompt(sql_results, compacted)}
 
 Answer:"""
 
-    response = model.generate_content(prompt)
+async def generate_natural_language_answer(user_query: str, sql_results: list, sql_query: str, compacted: bool = False):
+    """Writes the answer from the sql results (see `build_answer_prompt`)."""
+    if not sql_results:
+        return "No data found."
+    
+    prompt = build_answer_prompt(user_query, sql_results, sql_query, compacted)
+
+    async with answer_limit:
+        response = await model.generate_content_async(prompt)
     return response.text.strip()
 
 @app.post("/text_to_sql")
@@ -138,19 +245,128 @@ async def text_to_sql(request: QueryRequest):
             `json_data`
             `answer`
             `records_returned`
+            `results_compacted` (whether the answer was written from a summary of the results)
+            `row_limit_applied` (whether the results were cut at QUERY_MAX_ROWS)
+
+        A query the guard rejects comes back as a 400, one that runs past its deadline as a 408.
     """
-    sql_query = generate_sql_from_natural_language(request.user_query)
-    sql_results = execute_sql_query(sql_query)
-    natural_answer = generate_natural_language_answer(request.user_query, sql_results, sql_query)
+    sql_query = await generate_sql_from_natural_language(request.user_query)
+    try:
+        sql_results = await run_sql_query(sql_query)
+    except Exception:
+        #sql that doesn't run shouldn't be served from the cache again
+        sql_cache.discard(request.user_query, schema_cache.version)
+        raise
+    #large results are summarized so the answer prompt stays within budget
+    prompt_results, compacted = compact_results(sql_results, ANSWER_RESULT_BUDGET_BYTES)
+    natural_answer = await generate_natural_language_answer(request.user_query, prompt_results, sql_query, compacted)
     
     return JSONResponse(content={
         "user_query": request.user_query,
         "sql_query": sql_query,
         "json_data": sql_results,
         "answer": natural_answer,
-        "records_returned": len(sql_results)
+        "records_returned": len(sql_results),
+        "results_compacted": compacted,
+        "row_limit_applied": bool(QUERY_MAX_ROWS) and not has_limit(sql_query) and len(sql_results) >= QUERY_MAX_ROWS
     })
 
+async def stream_sql_rows(query: str, chunk_rows: int = STREAM_CHUNK_ROWS):
+    """
+    Yields the result rows of `query` in chunks straight from the cursor.
+
+    The stream gets its own backend connection so its open cursor never shares a connection
+    with other queries, each `fetchmany` runs on the sql thread pool. The query deadline counts
+    the time spent executing and fetching, not the time the client takes to read the chunks.
+    Cached results are replayed from the result cache instead.
+    """
+    loop = asyncio.get_running_loop()
+    query = query_guard.prepare(query, max_rows=STREAM_MAX_ROWS)
+
+    def open_stream():
+        cached = result_cache.get(result_cache.make_key(query, referenced_tables(query, backend.tables())))
+        if cached is not None:
+            log_query(query)
+            return None, cached
+        print(f"STREAMING SQL: {query}")
+        start = time.perf_counter()
+        stream = backend.open_stream(query)
+        log_query(query, (time.perf_counter() - start) * 1000)
+        return stream, None
+
+    stream, cached = await loop.run_in_executor(sql_executor, open_stream)
+    if cached is not None:
+        for start in range(0, len(cached), chunk_rows):
+            yield cached[start:start + chunk_rows]
+        return
+    try:
+        while True:
+            rows = await loop.run_in_executor(sql_executor, stream.fetchmany, chunk_rows)
+            if not rows:
+                break
+            yield [dict(zip(stream.columns, row)) for row in rows]
+    finally:
+        stream.close()
+
+def ndjson_line(event: dict) -> bytes:
+    """One NDJSON event"""
+    return (json.dumps(event, default=str) + "\n").encode("utf-8")
+
+async def stream_text_to_sql(user_query: str):
+    """
+    Runs the text2sql pipeline as a stream of NDJSON events:
+        - {"type": "sql"} as soon as the sql exists
+        - {"type": "rows"} chunks of result rows as they are read
+        - {"type": "rows_done"} with the row count and whether the answer uses a summary
+        - {"type": "answer"} answer text pieces as the model writes them
+        - {"type": "done"} or {"type": "error"}
+    Only a bounded summary of the rows is kept in memory for the answer prompt.
+    """
+    try:
+        sql_query = await generate_sql_from_natural_language(user_query)
+        yield ndjson_line({"type": "sql", "user_query": user_query, "sql_query": sql_query})
+
+        summarizer = ResultSummarizer(budget_bytes=ANSWER_RESULT_BUDGET_BYTES)
+        try:
+            async for rows in stream_sql_rows(sql_query):
+                summarizer.add_rows(rows)
+                yield ndjson_line({"type": "rows", "rows": rows})
+        except Exception:
+            sql_cache.discard(user_query, schema_cache.version)
+            raise
+        prompt_results, compacted = summarizer.finish()
+        yield ndjson_line({"type": "rows_done", "records_returned": summarizer.row_count, "results_compacted": compacted})
+
+        if summarizer.row_count == 0:
+            yield ndjson_line({"type": "answer", "text": "No data found."})
+        else:
+            prompt = build_answer_prompt(user_query, prompt_results, sql_query, compacted)
+            async with answer_limit:
+                response = await model.generate_content_async(prompt, stream=True)
+                async for chunk in response:
+                    if chunk.text:
+                        yield ndjson_line({"type": "answer", "text": chunk.text})
+        yield ndjson_line({"type": "done"})
+    except (QueryRejected, QueryTimeout) as e:
+        yield ndjson_line({"type": "error", "message": str(e), **e.to_dict()})
+    except Exception as e:
+        yield ndjson_line({"type": "error", "message": str(e)})
+
+@app.post("/text_to_sql/stream")
+async def text_to_sql_stream(request: QueryRequest):
+    """
+    Streaming variant of /text_to_sql.
+
+    Returns NDJSON (one json event per line, see `stream_text_to_sql`) so the sql, the result rows
+    and the answer reach the client as soon as each exists.
+    """
+    return StreamingResponse(stream_text_to_sql(request.user_query), media_type="application/x-ndjson")
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Returns the hit/miss counters of the text2sql caches."""
+    return {"sql_cache": sql_cache.stats(), "result_cache": result_cache.stats()}
+
 #-------------main api complete-----------------------
 def list_dirs(file_names:List[str]):
     """
@@ -162,37 +378,6 @@ def list_dirs(file_names:List[str]):
             required_map[Path(file).stem]=Path(os.path.join(UPLOAD_DIR,file))
     return required_map
     
-def load_existing_summaries(summary_file):
-    """Load existing all_summaries.json if present"""
-    if os.path.exists(summary_file):
-        try:
-            #tries to return tbe json (IF SUMMARY FILE NOT EMPTY)
-            with open(summary_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            print(f"Error(maybe file empty)")
-            #NO EXISTING SUMMARY IN THE FILE CURRENTLY
-            return {}
-    return {}
-
-
-def load_existing_summaries(filepath):
-    """Load existing all_summaries.json if present"""
-    if os.path.exists(filepath):
-        try:
-            #tries to return tbe json (IF SUMMARY FILE NOT EMPTY)
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            print(f"Error(maybe file empty)")
-            #NO EXISTING SUMMARY IN THE FILE CURRENTLY
-            return {}
-    return {}
-
-def save_summaries(filepath, summaries):
-    """Save JSON summaries with indentation"""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(summaries, f, indent=4)
 #all i need to do is add the data to the db, then perform the complete setup which makes a simple summary which i add to all_summaries.json
 #then i need to perform the statistical basic profiling for that data and add it to all_profiles.json
 #then i need to perform the llm profiling for the data and add it to ll_profiles.json or complete_profiles.json
@@ -201,113 +386,119 @@ def save_summaries(filepath, summaries):
     #2 another which takes in data and performs all above and text2sql , so json data ={files:files, user_query:query}
 #later i need to change the way i do the text2sql by using the sql probes
 
-def update_db(filenames:list[str]):
+def update_db(filenames:list[str], file_hashes:dict=None, progress=None):
     """
-    Inserts the csv files as tables into the db:`cloud_costs.db`.
-    Then it saves the simple summary of each table into the all_summaries.json file
+    Inserts the csv files as tables into the db:`cloud_costs.db`, profiles them, writes their
+    llm descriptions and publishes the merged profiles in the catalog.
+    `progress(table_name, stage, status)` is called as each stage starts and ends.
 
+    Returns:
+        - per table report of which stages ran or were skipped and how long each took
     """
-    #so im updating the db with the new files/even old files, so i need to check if this filename already exists then dont change unless the data is bigger
-    #get the required map:
     required_map=list_dirs(filenames)
     print('Detected CSV:',required_map)
-    setup=DatabaseSetup(required_map)
-    setup.setup_complete()
-    summary=setup.get_database_summary()
-    all_profiles = load_existing_summaries(SUMMARY_FILE)
-    print("Existing tables:", list(all_profiles.keys()) if all_profiles else "None")
-    updated = 0
-    added = 0
-    skipped = 0
-
-    for table_name, table_info in summary['tables'].items():
-        new_rows = table_info.get('rows', 0)
-
-        if table_name not in all_profiles:
-            all_profiles[table_name] = table_info
-            added += 1
-            print(f"Added new table: {table_name} ({new_rows} rows)")
-        else:
-            old_rows = all_profiles[table_name].get('rows', 0)
-            if new_rows > old_rows:
-                all_profiles[table_name] = table_info
-                updated += 1
-                print(f"Updated table: {table_name} ({old_rows} → {new_rows} rows)")
-            else:
-                skipped += 1
-                print(f"Skipped {table_name} (old rows: {old_rows}, new rows: {new_rows})")
-
-    save_summaries(SUMMARY_FILE, all_profiles)
-    #till here it saves everything to all_summaries.json
-    #now i have to perform the basic profiling on these specific tables
-    #so since filenames is the complete one with '.csv' , ill have to pass just the table names
-    table_names=list(required_map.keys())
-    print("Detected Table names:",table_names)
-    profiler=DatabaseProfiler(table_map=table_names)
-    basic_profile=profiler.profile_all_tables() #another thing just like summary
-    all_basic_profiles=load_existing_summaries(PROFILE_FILE)
-
-    updated=0
-    added=0
-    skipped=0
-    # for table_name,table_info in basic_profile.keys()
-    for table_name, table_info in basic_profile.items():
-        new_rows = table_info.get('row_count', 0)
-
-        if table_name not in all_basic_profiles:
-            all_basic_profiles[table_name] = table_info
-            added += 1
-            print(f"Added new table: {table_name} ({new_rows} rows)")
-        else:
-            old_rows = all_basic_profiles[table_name].get('row_count', 0)
-            if new_rows > old_rows:
-                all_basic_profiles[table_name] = table_info
-                updated += 1
-                print(f"Updated table: {table_name} ({old_rows} → {new_rows} rows)")
-            else:
-                basic_profile[table_name]=all_basic_profiles[table_name] #updating basic_profile dict
-                skipped += 1
-                print(f"Skipped {table_name} (old rows: {old_rows}, new rows: {new_rows})")
-    save_summaries(PROFILE_FILE, all_basic_profiles)
-    #this now saves the basic profiling summary to the PROFILE FILE
-    #now i have to make the llm profiles using the llm_profiling.py class LLMProfilingSummarizer
-    #i can also continue to use the `basic_profile` dict since i keep it updated
-    llm_profiler=LLMProfilingSummarizer(llm_client=model)
-    for table_name in table_names:
-        prompt=llm_profiler.create_profile_prompt(table_name=table_name,profile_data=basic_profile[table_name])
-        response = model.generate_content(prompt)
-        result_text = response.text
-        #path for the file to place the llm profile data into
-        llm_profile_save_file=LLM_PROFILE_DIR+table_name+'.json'
-        json_data=result_text.strip().replace('```json','').replace('```', '').strip()
-        parsed_json = json.loads(json_data)
-
-        with open(llm_profile_save_file, 'w') as f:
-            json.dump(parsed_json, f, indent=2)
-    #so now this saves the llm summaries to specific table name.json files in separate_llm_profiles
-    #now i gotta compile it all together in complete_profiles.json
-    #so i have the basic_profile dict
-    #and the multiple files with table names llm _decriptions dicts when loaded
-    # complete_summary_file=COMPLETE_SUMMARY_FILE #complete_profiles.json
-    #just open each llm profile file and add it into the basic profile dict and at the end just write to the complete dict
-    complete_summary=basic_profile.copy()
-    for table_name in table_names:
-        llm_profile_save_file=LLM_PROFILE_DIR+table_name+'.json'
-        llm_profile=load_existing_summaries(llm_profile_save_file)
-        # llm_profile[table_name]={short,long}
-        for col_name,col_data in complete_summary[table_name]['columns'].items():
-            # basic_profile[table_name]['columns'][col_name]=col_data
-            col_data.update(llm_profile[col_name])
-    save_summaries(COMPLETE_SUMMARY_FILE,complete_summary)
+    report = pipeline.run(required_map, file_hashes, progress)
+
+    #published profiles bump the catalog version, which the schema context picks up on its own
+    #cached sql that reads any of the rewritten tables is stale
+    ingested = ProfilingPipeline.stages_ran(report, 'ingest')
+    sql_cache.invalidate_tables(ingested)
+    #the rollups of the rewritten cost tables only aggregate the billing periods they don't have yet
+    for table_name, result in rollups.refresh(ingested).items():
+        report[table_name].append({'stage': 'rollup', 'status': result['mode'], 'rows': result.get('rows')})
+        if result['mode'] != 'failed':
+            ingested.append(result['rollup'])
+    #the duckdb backend reads parquet copies of the rewritten tables
+    if ingested and backend.name != 'sqlite':
+        backend.load_tables(DB_PATH, ingested)
+        for table_name in ingested:
+            result_cache.invalidate_table(table_name)
+    #rebuilt tables only kept the indexes they had, index the logged queries' columns for the new data
+    #(without timing the logged queries, that would run each of them twice per ingest)
+    if ingested:
+        index_advisor.run(tables=ingested, measure=False)
+    return report
+
+def run_ingest_job(job_id: str, tables: dict, progress):
+    """Job handler: runs update_db for the tables of one queued upload"""
+    filenames = [entry['filename'] for entry in tables.values()]
+    file_hashes = {table_name: entry['sha256'] for table_name, entry in tables.items()}
+    return update_db(filenames, file_hashes, progress)
+
+def setup_services():
+    """Creates the api's databases, caches and workers, called once by `lifespan` on startup"""
+    global read_pool, backend, sql_cache, index_advisor, catalog, schema_cache, rollups, pipeline, ingest_jobs
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+    read_pool = ReadOnlyConnectionPool(DB_PATH)
+    #ingest always writes the sqlite db and exports to the backend from there
+    backend = create_backend(EXECUTION_BACKEND, DB_PATH, parquet_dir=PARQUET_DIR, read_pool=read_pool, guard=query_guard)
+    sql_cache = NLToSQLCache(QUERY_CACHE_DB)
+    #logs the executed sql and builds indexes for the columns it filters, joins and groups on
+    index_advisor = IndexAdvisor(DB_PATH, log_db_path=QUERY_LOG_DB, disk_budget_bytes=INDEX_DISK_BUDGET_BYTES,
+                                 guard=query_guard)
+
+    catalog = Catalog(CATALOG_DB, summary_file=SUMMARY_FILE, profile_file=PROFILE_FILE, llm_profile_dir=LLM_PROFILE_DIR,
+                      complete_file=COMPLETE_SUMMARY_FILE, state_file=PIPELINE_STATE_FILE,
+                      description_cache_file=COLUMN_DESCRIPTION_CACHE)
+    #the schema context is built once and only rebuilt when the catalog's published profiles change
+    #each prompt then only carries the tables/columns relevant to the query
+    schema_cache = SchemaContextCache(catalog, SCHEMA_TOP_K_TABLES, SCHEMA_TOP_K_COLUMNS,
+                                      dialect=backend.name, dialect_hint=backend.dialect_hint)
+
+    #pre-aggregated cost tables (day x service x region x account), registered in the catalog for the schema context
+    rollups = RollupManager(DB_PATH, catalog, result_cache=result_cache)
+    #ingest -> stats -> llm -> merge, each stage is skipped when its inputs didn't change
+    pipeline = ProfilingPipeline(
+        model, catalog, db_path=DB_PATH,
+        result_cache=result_cache, chunk_rows=INGEST_CHUNK_ROWS,
+        llm_concurrency=LLM_PROFILING_CONCURRENCY, llm_requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+        llm_batch_columns=LLM_BATCH_COLUMNS,
+        approx_threshold_rows=APPROX_PROFILE_ROWS, profile_workers=PROFILE_WORKERS,
+    )
+    ingest_jobs = JobQueue(run_ingest_job, db_path=JOBS_DB, workers=INGEST_JOB_WORKERS)
+
+
+async def save_upload(file: UploadFile, upload_location: str, known_hash: str = None):
+    """
+    Streams an upload to disk in fixed-size chunks while hashing it.
 
+    The bytes go to a temp file next to the destination, which is atomically renamed over
+    `upload_location` only when the content differs from `known_hash`.
+
+    Returns:
+        - (sha256 hex digest, whether the file changed)
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(upload_location) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                digest.update(chunk)
+                f.write(chunk)
+        sha256 = digest.hexdigest()
+        if sha256 == known_hash and os.path.exists(upload_location):
+            os.remove(temp_path)
+            return sha256, False
+        os.replace(temp_path, upload_location)
+        return sha256, True
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 @app.post("/upload_csv")
 async def uploads_data_to_db(files: list[UploadFile] = File(...)):
     """
-    Saves the users csv file to the `upload` directory, then saves the data to the cloud_costs.db.
+    Saves the users csv file to the `upload` directory and queues a job that loads it into cloud_costs.db
+    and profiles it. Poll `/jobs/{job_id}` for its progress.
+    Files whose bytes are identical to the last ingest of that table, or to the upload a pending job
+    for that table will ingest, are not processed again.
     """
-    saved_files = {}
     filenames=[]
+    queued_tables = {}
+    unchanged = []
     for file in files:
         if not file.filename.lower().endswith('.csv'):
             continue
@@ -315,15 +506,56 @@ async def uploads_data_to_db(files: list[UploadFile] = File(...)):
         # Get just the filename (not full path)
         filename = os.path.basename(file.filename)
         upload_location = os.path.join(UPLOAD_DIR, filename)
+        table_name = Path(filename).stem
         
-        # Read file content and save it
-        content = await file.read()
-        with open(upload_location, 'wb') as f:
-            f.write(content)
-        filenames.append(file.filename)
-
-    update_db(filenames)
-    return {"message": "Files uploaded successfully"}
+        #stream the file to disk, a byte-identical re-upload skips the whole update_db pipeline
+        #while a job for the table is pending the file on disk is that job's, not the last ingested one
+        pending = ingest_jobs.pending_hash(table_name)
+        known_hash = pending if pending is not None else pipeline.ingested_hash(table_name)
+        sha256, changed = await save_upload(file, upload_location, known_hash)
+        if not changed and (pending is not None or pipeline.is_current(table_name, sha256)):
+            print(f"Skipped {filename}: identical to the last upload")
+            unchanged.append(filename)
+            continue
+        filenames.append(filename)
+        queued_tables[table_name] = {'filename': filename, 'sha256': sha256}
+
+    if not queued_tables:
+        return {"message": "Nothing to process", "job_id": None, "queued": [], "unchanged": unchanged}
+    job = ingest_jobs.enqueue(queued_tables)
+    return {"message": "Files uploaded, processing in the background", "job_id": job['job_id'],
+            "coalesced": job['coalesced'], "queued": filenames, "unchanged": unchanged}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Status of an upload job: queued/running/succeeded/failed, the current stage of every table,
+    per-stage timings once finished and the error if it failed.
+    """
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+@app.post("/index_advisor/run")
+async def run_index_advisor():
+    """
+    Creates indexes for the logged queries that scan a table and drops the automatic indexes
+    no logged query needs, within INDEX_DISK_BUDGET_BYTES.
+
+    Returns:
+        - the created/dropped indexes and the latency of the affected queries before and after
+    """
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, index_advisor.run)
+    return report
+
+@app.get("/index_advisor/report")
+async def index_advisor_report():
+    """Report of the last index advisor run"""
+    if index_advisor.last_report is None:
+        raise HTTPException(status_code=404, detail="The index advisor has not run yet")
+    return index_advisor.last_report
 
     
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter over 64-bit hashes, vectorized with numpy.
+
+    `2**precision` one-byte registers (16 KiB at the default 14), relative standard error 1.04/sqrt(m).
+    """
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray):
+        """Adds an array of uint64 hashes"""
+        if len(hashes) == 0:
+            return
+        hashes = hashes.astype(np.uint64, copy=False)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)
+        #rank = position of the leftmost 1 bit in the remaining 64-p bits
+        with np.errstate(divide='ignore'):
+            top_bit = np.floor(np.log2(rest.astype(np.float64)))
+        rank = np.where(rest == 0, 64 - self.precision + 1, 64 - top_bit).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def add_series(self, values: pd.Series):
+        """Adds the non-null values of a series"""
+        values = values.dropna()
+        if values.empty:
+            return
+        if pd.api.types.is_numeric_dtype(values):
+            #int and float chunks of the same column must hash alike
+            hashes = pd.util.hash_array(values.to_numpy(dtype=np.float64))
+        else:
+            hashes = pd.util.hash_array(values.astype(str).to_numpy(dtype=object))
+        self.add_hashes(hashes)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(self.m)
+
+    def estimate(self) -> float:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * self.m and zeros:
+            #small range correction (linear counting)
+            return self.m * math.log(self.m / zeros)
+        return raw
+
+
+class Reservoir:
+    """Uniform sample of `size` values from a stream (algorithm R, applied a chunk at a time)"""
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.values = []
+
+    def add(self, values):
+        values = list(values)
+        fill = min(len(values), self.size - len(self.values))
+        if fill > 0:
+            self.values.extend(values[:fill])
+        rest = len(values) - fill
+        if rest > 0:
+            positions = np.arange(self.seen + fill, self.seen + len(values))
+            slots = self.rng.integers(0, positions + 1)
+            for offset in np.nonzero(slots < self.size)[0]:
+                self.values[slots[offset]] = values[fill + offset]
+        self.seen += len(values)
+
+
+class ApproximateProfiler:
+    """
+    Single-pass profiler for very large tables.
+
+    Streams the table `chunk_rows` rows at a time and keeps constant memory per column: exact null
+    and row counters, exact running min/max and string lengths, a HyperLogLog sketch for the
+    distinct count and a reservoir sample for the sample values and string patterns.
+
+    Output has the shape of `DatabaseProfiler.profile_table`, plus for every column:
+        - distinct_count_error: relative standard error of the distinct count
+        - distinct_count_bounds: [low, high] ~95% interval of the distinct count
+        - patterns_sample_size: values the pattern counts were extrapolated from (text columns)
+    and `profile_mode: "approximate"` on the table.
+    """
+    def __init__(self, conn, chunk_rows=100000, hll_precision=14, sample_size=10,
+                 pattern_sample_size=10000, seed=0):
+        self.conn = conn
+        self.chunk_rows = chunk_rows
+        self.hll_precision = hll_precision
+        self.sample_size = sample_size
+        self.pattern_sample_size = pattern_sample_size
+        self.seed = seed
+
+    def profile_table(self, table_name, extract_patterns):
+        """
+        Args:
+            - table_name
+            - extract_patterns: function(pd.Series) -> {pattern: count}, run on the reservoir sample
+        """
+        rng = np.random.default_rng(self.seed)
+        cursor = self.conn.execute('SELECT * FROM "' + table_name.replace('"', '""') + '"')
+        columns = [description[0] for description in cursor.description]
+        state = {column: {
+            'nulls': 0, 'non_null': 0, 'text': False, 'float': False,
+            'min': None, 'max': None, 'min_length': None, 'max_length': None,
+            'hll': HyperLogLog(self.hll_precision),
+            'reservoir': Reservoir(max(self.sample_size, self.pattern_sample_size), rng),
+        } for column in columns}
+        row_count = 0
+
+        while rows := cursor.fetchmany(self.chunk_rows):
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            row_count += len(df)
+            for column in columns:
+                self._update(state[column], df[column])
+
+        profile = {
+            'table_name': table_name,
+            'row_count': int(row_count),
+            'profile_mode': 'approximate',
+            'columns': {column: self._finish(state[column], row_count, extract_patterns) for column in columns},
+        }
+        return profile
+
+    def _update(self, stats, values: pd.Series):
+        non_null = values.dropna()
+        stats['nulls'] += int(len(values) - len(non_null))
+        stats['non_null'] += int(len(non_null))
+        if non_null.empty:
+            return
+        stats['hll'].add_series(non_null)
+        stats['reservoir'].add(non_null.tolist())
+
+        if pd.api.types.is_numeric_dtype(non_null) and not stats['text']:
+            if pd.api.types.is_float_dtype(non_null):
+                stats['float'] = True
+            low, high = float(non_null.min()), float(non_null.max())
+            stats['min'] = low if stats['min'] is None else min(stats['min'], low)
+            stats['max'] = high if stats['max'] is None else max(stats['max'], high)
+        else:
+            stats['text'] = True
+
+        lengths = non_null.astype(str).str.len()
+        low, high = int(lengths.min()), int(lengths.max())
+        stats['min_length'] = low if stats['min_length'] is None else min(stats['min_length'], low)
+        stats['max_length'] = high if stats['max_length'] is None else max(stats['max_length'], high)
+
+    def _finish(self, stats, row_count, extract_patterns):
+        non_null = stats['non_null']
+        if stats['text'] or not non_null:
+            data_type = 'object'
+        elif stats['float'] or stats['nulls']:
+            data_type = 'float64'
+        else:
+            data_type = 'int64'
+        numeric = data_type != 'object'
+
+        hll = stats['hll']
+        estimate = min(round(hll.estimate()), non_null)
+        margin = 2 * hll.relative_error * estimate
+        sample = stats['reservoir'].values
+        sample_values = sample[:self.sample_size]
+        if data_type == 'float64':
+            sample_values = [float(value) for value in sample_values]
+
+        column = {
+            'null_count': int(stats['nulls']),
+            'distinct_count': int(estimate),
+            'data_type': data_type,
+            'sample_values': sample_values,
+            'min_value': stats['min'] if numeric else None,
+            'max_value': stats['max'] if numeric else None,
+            'distinct_count_error': round(hll.relative_error, 4),
+            'distinct_count_bounds': [int(max(1 if non_null else 0, math.floor(estimate - margin))),
+                                      int(min(non_null, math.ceil(estimate + margin)))],
+        }
+        if not numeric:
+            #pattern counts from the sample, scaled to every non-null value
+            sample_patterns = extract_patterns(pd.Series(sample, dtype=object)) if sample else {}
+            scale = non_null / len(sample) if sample else 0
+            column.update({
+                'min_length': stats['min_length'],
+                'max_length': stats['max_length'],
+                'common_patterns': {name: int(round(count * scale)) for name, count in sample_patterns.items()},
+                'patterns_sample_size': len(sample),
+            })
+        return column
@@ -0,0 +1,311 @@
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from db_pool import ReadOnlyConnectionPool
+from sql_guard import Deadline
+
+logger = logging.getLogger(__name__)
+
+#duckdb and pyarrow are only needed for the duckdb backend
+try:
+    import duckdb
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    duckdb = None
+    pa = None
+    pq = None
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _guard_error(translate, error):
+    """Raises what the guard makes of `error` (QueryTimeout/QueryRejected), or `error` itself"""
+    translated = translate(error) if translate else error
+    if translated is error:
+        raise error
+    raise translated from error
+
+
+class ResultStream:
+    """An open cursor of a streamed query on its own connection, closed by the caller"""
+    def __init__(self, conn, cursor, translate=None, deadline=None):
+        self.conn = conn
+        self.cursor = cursor
+        self.translate = translate
+        self.deadline = deadline
+        self.columns = [description[0] for description in cursor.description or []]
+
+    def fetchmany(self, size):
+        try:
+            if self.deadline is None:
+                return self.cursor.fetchmany(size)
+            #the deadline only runs while fetching, not while the caller consumes the rows
+            with self.deadline.running():
+                return self.cursor.fetchmany(size)
+        except Exception as e:
+            _guard_error(self.translate, e)
+
+    def close(self):
+        if self.deadline is not None:
+            self.deadline.stop()
+        self.conn.close()
+
+
+class ExecutionBackend:
+    """
+    Where the generated sql runs.
+
+    `tables()` lists what queries can read, `read_frame(sql)` runs one query to a dataframe and
+    `open_stream(sql)` runs it on a dedicated connection for reading in chunks. With a `guard`
+    (sql_guard.QueryGuard) both run under its deadline and plan checks. `load_tables` brings
+    freshly ingested tables over from the sqlite ingest db, `dialect_hint` goes into the text2sql prompt.
+    """
+    name = None
+    dialect_hint = None
+    guard = None
+
+    def tables(self) -> list:
+        raise NotImplementedError
+
+    def read_frame(self, sql: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def open_stream(self, sql: str) -> ResultStream:
+        raise NotImplementedError
+
+    def load_tables(self, db_path, tables):
+        """Makes the given tables of the sqlite db at `db_path` queryable, returns {table: rows}"""
+        return {}
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(ExecutionBackend):
+    """The ingest db itself, read through the per-thread read-only connection pool"""
+    name = 'sqlite'
+    dialect_hint = ("SQLite. Timestamps are ISO-8601 text ('YYYY-MM-DD HH:MM:SS'): compare them as strings, "
+                    "bucket them with strftime/substr or the <column>_day/<column>_month columns.")
+
+    def __init__(self, read_pool: ReadOnlyConnectionPool, guard=None):
+        self.read_pool = read_pool
+        self.guard = guard
+
+    def tables(self):
+        conn = self.read_pool.get_connection()
+        return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table','view')")]
+
+    def read_frame(self, sql):
+        conn = self.read_pool.get_connection()
+        if self.guard is None:
+            return pd.read_sql(sql, conn)
+        with self.guard.limits(conn):
+            self.guard.check_plan(conn, sql)
+            return pd.read_sql(sql, conn)
+
+    def open_stream(self, sql):
+        conn = self.read_pool.open_connection()
+        translate = deadline = None
+        try:
+            if self.guard is not None:
+                deadline = Deadline(self.guard.timeout_seconds)
+                translate = self.guard.install(conn, deadline)
+                with deadline.running():
+                    self.guard.check_plan(conn, sql)
+                    cursor = conn.execute(sql)
+            else:
+                cursor = conn.execute(sql)
+        except Exception as e:
+            conn.close()
+            _guard_error(translate, e)
+        return ResultStream(conn, cursor, translate, deadline)
+
+    def close(self):
+        self.read_pool.close_all()
+
+
+class DuckDBBackend(ExecutionBackend):
+    """
+    Embedded columnar engine over Parquet exports of the ingested tables.
+
+    Every `<table>.parquet` in `parquet_dir` is a view of the same name. Tables are exported from the
+    sqlite ingest db by `load_tables`, `chunk_rows` rows at a time, into a temporary file that
+    replaces the old one, so running queries keep reading the previous file.
+    Timestamp columns become native TIMESTAMP columns, everything else keeps its sqlite type.
+    """
+    name = 'duckdb'
+    dialect_hint = ("DuckDB. Timestamp columns are TIMESTAMP: use date_trunc('day'|'month', col), "
+                    "strftime(col, '%Y-%m'), col >= TIMESTAMP '2024-01-01' or the <column>_day/<column>_month "
+                    "text columns. Double-quote identifiers, not backticks.")
+
+    def __init__(self, parquet_dir='parquet', threads=None, chunk_rows=100000, guard=None):
+        if duckdb is None:
+            raise ImportError("the duckdb backend needs the duckdb and pyarrow packages")
+        self.parquet_dir = Path(parquet_dir)
+        self.parquet_dir.mkdir(parents=True, exist_ok=True)
+        self.chunk_rows = chunk_rows
+        self.guard = guard
+        self.conn = duckdb.connect(':memory:')
+        if threads:
+            self.conn.execute(f"SET threads={int(threads)}")
+        #the generated sql may only read the parquet exports: no other files, urls or extensions, and no way to undo that
+        allowed = (str(self.parquet_dir.resolve()) + os.sep).replace("'", "''")
+        self.conn.execute("SET autoinstall_known_extensions=false")
+        self.conn.execute("SET autoload_known_extensions=false")
+        self.conn.execute(f"SET allowed_directories=['{allowed}']")
+        self.conn.execute("SET enable_external_access=false")
+        self.conn.execute("SET lock_configuration=true")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._views = {}
+
+    def _files(self):
+        return {path.stem: path for path in self.parquet_dir.glob('*.parquet')}
+
+    def _sync_views(self, force=False):
+        """(Re)creates the views when parquet files were added or removed, or every view with `force`"""
+        files = self._files()
+        with self._lock:
+            if not force and set(files) == set(self._views):
+                return
+            for table in set(self._views) - set(files):
+                self.conn.execute(f"DROP VIEW IF EXISTS {_quote(table)}")
+            for table, path in files.items():
+                location = str(path.resolve()).replace("'", "''")
+                self.conn.execute(f"CREATE OR REPLACE VIEW {_quote(table)} AS SELECT * FROM read_parquet('{location}')")
+            self._views = files
+
+    def _cursor(self):
+        """This thread's duckdb cursor (cursors are independent connections to the same database)"""
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.conn.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def tables(self):
+        self._sync_views()
+        return list(self._views)
+
+    def read_frame(self, sql):
+        self._sync_views()
+        cursor = self._cursor()
+        if self.guard is None:
+            return cursor.execute(sql).df()
+        with self.guard.duckdb_limits(cursor):
+            return cursor.execute(sql).df()
+
+    def open_stream(self, sql):
+        self._sync_views()
+        cursor = self.conn.cursor()
+        deadline, translate = self.guard.start_deadline(cursor) if self.guard is not None else (None, None)
+        try:
+            if deadline is None:
+                cursor.execute(sql)
+            else:
+                with deadline.running():
+                    cursor.execute(sql)
+        except Exception as e:
+            cursor.close()
+            _guard_error(translate, e)
+        return ResultStream(cursor, cursor, translate, deadline)
+
+    def close(self):
+        self.conn.close()
+
+    #------ export from the ingest db ------
+    def load_tables(self, db_path, tables):
+        conn = sqlite3.connect(db_path, timeout=60)
+        try:
+            rows = {table: self.export_table(conn, table) for table in tables}
+        finally:
+            conn.close()
+        #rewritten files may have different columns
+        self._sync_views(force=True)
+        return rows
+
+    @staticmethod
+    def _arrow_types(conn, table):
+        """Arrow type of every column, from its declared type and the storage classes it actually holds"""
+        columns = [(row[1], (row[2] or '').upper()) for row in conn.execute(f"PRAGMA table_info({_quote(table)})")]
+        checks = []
+        for name, _ in columns:
+            column = _quote(name)
+            checks += [f"MAX(typeof({column}) IN ('text', 'blob'))", f"MAX(typeof({column}) = 'real')",
+                       f"MAX(typeof({column}) = 'integer')",
+                       f"MAX({column} IS NOT NULL AND {column} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*')"]
+        flags = conn.execute(f"SELECT {', '.join(checks)} FROM {_quote(table)}").fetchone() if columns else ()
+        types = {}
+        for position, (name, declared) in enumerate(columns):
+            texts, reals, integers, non_iso = flags[position * 4:position * 4 + 4]
+            if declared == 'TIMESTAMP' and texts and not non_iso and not reals and not integers:
+                types[name] = pa.timestamp('us')
+            elif texts or not (reals or integers):
+                types[name] = pa.string()
+            elif reals:
+                types[name] = pa.float64()
+            elif declared == 'BOOLEAN':
+                types[name] = pa.bool_()
+            else:
+                types[name] = pa.int64()
+        return types
+
+    @staticmethod
+    def _arrow_column(values, arrow_type):
+        series = pd.Series(values, dtype=object)
+        if pa.types.is_timestamp(arrow_type):
+            series = pd.to_datetime(series, format='ISO8601')
+        elif pa.types.is_boolean(arrow_type):
+            series = series.map(lambda value: value if value is None else bool(value))
+        elif pa.types.is_string(arrow_type):
+            series = series.map(lambda value: value if value is None or isinstance(value, str) else str(value))
+        return pa.array(series, type=arrow_type, from_pandas=True)
+
+    def export_table(self, conn, table):
+        """Writes one sqlite table to `<parquet_dir>/<table>.parquet`, returns its row count"""
+        types = self._arrow_types(conn, table)
+        schema = pa.schema(list(types.items()))
+        target = self.parquet_dir / f"{table}.parquet"
+        temporary = self.parquet_dir / f".{table}.parquet.tmp"
+        cursor = conn.execute(f"SELECT * FROM {_quote(table)}")
+        rows = 0
+        try:
+            with pq.ParquetWriter(temporary, schema, compression='zstd') as writer:
+                while batch := cursor.fetchmany(self.chunk_rows):
+                    columns = list(zip(*batch))
+                    arrays = [self._arrow_column(values, arrow_type)
+                              for values, arrow_type in zip(columns, types.values())]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                    rows += len(batch)
+            os.replace(temporary, target)
+        except Exception:
+            if temporary.exists():
+                temporary.unlink()
+            raise
+        logger.info(f"Exported {table} to {target} ({rows} rows)")
+        return rows
+
+
+def create_backend(name, db_path='cloud_costs.db', parquet_dir='parquet', read_pool=None, threads=None, guard=None):
+    """
+    Args:
+        - name: 'sqlite' or 'duckdb'
+        - read_pool: the sqlite read pool to use, a new one when None
+        - guard: QueryGuard every query runs under, none when None
+
+    Returns:
+        - the ExecutionBackend
+    """
+    if name == 'sqlite':
+        return SQLiteBackend(read_pool or ReadOnlyConnectionPool(db_path), guard=guard)
+    if name == 'duckdb':
+        return DuckDBBackend(parquet_dir, threads=threads, guard=guard)
+    raise ValueError(f"Unknown execution backend {name}")
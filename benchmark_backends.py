@@ -0,0 +1,127 @@
+"""
+Compares the execution backends on the same generated analytical queries.
+
+    python benchmark_backends.py --db cloud_costs.db --parquet-dir parquet --repeat 5
+
+Queries are generated from the tables of the sqlite db: totals, top-N group-bys, two-column
+group-bys, distinct counts and filtered monthly trends over the cost-like (numeric) and
+low-cardinality text columns. Tables without a parquet copy are exported first.
+"""
+import argparse
+import json
+import sqlite3
+import statistics
+import time
+
+from backends import DuckDBBackend, SQLiteBackend
+from db_pool import ReadOnlyConnectionPool
+
+MAX_GROUP_DISTINCT = 1000
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def table_columns(conn, table):
+    """(numeric columns, low-cardinality text columns, month column or None) of a table"""
+    columns = [(row[1], (row[2] or '').upper()) for row in conn.execute(f"PRAGMA table_info({_quote(table)})")]
+    numeric, text = [], []
+    for name, declared in columns:
+        kinds = conn.execute(f"""SELECT MAX(typeof({_quote(name)}) IN ('integer', 'real')),
+                                        MAX(typeof({_quote(name)}) = 'text') FROM {_quote(table)}""").fetchone()
+        if kinds[0] and not kinds[1] and declared != 'BOOLEAN':
+            numeric.append(name)
+        elif kinds[1] and declared != 'TIMESTAMP':
+            distinct = conn.execute(f"SELECT COUNT(DISTINCT {_quote(name)}) FROM {_quote(table)}").fetchone()[0]
+            if 1 < distinct <= MAX_GROUP_DISTINCT:
+                text.append(name)
+    month = next((name for name, _ in columns if name.endswith('_month')), None)
+    return numeric, [name for name in text if name != month], month
+
+
+def generate_queries(conn, tables, per_table=3):
+    """Portable (sqlite and duckdb) queries over each table"""
+    queries = []
+    for table in tables:
+        numeric, text, month = table_columns(conn, table)
+        t = _quote(table)
+        for measure in numeric[:per_table]:
+            m = _quote(measure)
+            queries.append(f"SELECT COUNT(*), SUM({m}), AVG({m}) FROM {t}")
+            queries.append(f"SELECT MIN({m}), MAX({m}) FROM {t} WHERE {m} > 0")
+            for dimension in text[:per_table]:
+                d = _quote(dimension)
+                queries.append(f"SELECT {d}, SUM({m}) AS total FROM {t} GROUP BY {d} ORDER BY total DESC, {d} LIMIT 10")
+            if len(text) >= 2:
+                d1, d2 = _quote(text[0]), _quote(text[1])
+                queries.append(f"SELECT {d1}, {d2}, SUM({m}), COUNT(*) FROM {t} GROUP BY {d1}, {d2}")
+            if month and text:
+                top = conn.execute(f"SELECT {_quote(text[0])} FROM {t} GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+                value = str(top).replace("'", "''")
+                queries.append(f"""SELECT {_quote(month)}, SUM({m}) FROM {t} WHERE {_quote(text[0])} = '{value}'
+                                   GROUP BY {_quote(month)} ORDER BY {_quote(month)}""")
+        for dimension in text[:per_table]:
+            queries.append(f"SELECT COUNT(DISTINCT {_quote(dimension)}) FROM {t}")
+    return queries
+
+
+def time_query(backend, sql, repeat):
+    timings, rows = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frame = backend.read_frame(sql)
+        timings.append((time.perf_counter() - start) * 1000)
+        rows = len(frame)
+    return statistics.median(timings), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='cloud_costs.db')
+    parser.add_argument('--parquet-dir', default='parquet')
+    parser.add_argument('--tables', nargs='*', help='tables to benchmark, all when omitted')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--export', action='store_true', help='re-export every table to parquet first')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    tables = args.tables or [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%__staging'")]
+    queries = generate_queries(conn, tables)
+    conn.close()
+
+    sqlite_backend = SQLiteBackend(ReadOnlyConnectionPool(args.db))
+    duckdb_backend = DuckDBBackend(args.parquet_dir)
+    missing = tables if args.export else [table for table in tables if table not in duckdb_backend.tables()]
+    if missing:
+        start = time.perf_counter()
+        duckdb_backend.load_tables(args.db, missing)
+        print(f"Exported {len(missing)} tables to parquet in {time.perf_counter() - start:.2f}s")
+
+    results = []
+    for sql in queries:
+        sqlite_ms, sqlite_rows = time_query(sqlite_backend, sql, args.repeat)
+        duckdb_ms, duckdb_rows = time_query(duckdb_backend, sql, args.repeat)
+        results.append({'sql': ' '.join(sql.split()), 'sqlite_ms': round(sqlite_ms, 2), 'duckdb_ms': round(duckdb_ms, 2),
+                        'speedup': round(sqlite_ms / duckdb_ms, 2) if duckdb_ms else None,
+                        'rows_match': sqlite_rows == duckdb_rows})
+        print(f"{sqlite_ms:10.2f} ms {duckdb_ms:10.2f} ms  x{results[-1]['speedup']!s:<6} {results[-1]['sql'][:90]}")
+
+    total_sqlite = sum(result['sqlite_ms'] for result in results)
+    total_duckdb = sum(result['duckdb_ms'] for result in results)
+    print(f"\n{len(results)} queries, median per query summed: sqlite {total_sqlite:.1f} ms, duckdb {total_duckdb:.1f} ms")
+    mismatched = [result['sql'] for result in results if not result['rows_match']]
+    if mismatched:
+        print(f"Row counts differ for {len(mismatched)} queries: {mismatched}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    sqlite_backend.close()
+    duckdb_backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS table_summaries (
+    table_name TEXT PRIMARY KEY,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS table_stats (
+    table_name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS column_stats (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    stats TEXT NOT NULL,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE IF NOT EXISTS column_llm (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    short_description TEXT,
+    long_description TEXT,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE IF NOT EXISTS published_tables (
+    table_name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}',
+    published_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS published_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    profile TEXT NOT NULL,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE IF NOT EXISTS pipeline_state (
+    table_name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_fp TEXT,
+    output_fp TEXT,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (table_name, stage)
+);
+CREATE TABLE IF NOT EXISTS description_cache (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    short_description TEXT,
+    long_description TEXT,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    rollup_name TEXT PRIMARY KEY,
+    source_table TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    watermark TEXT,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+#table-level keys of a profile that get their own catalog columns
+PROFILE_KEYS = ('table_name', 'row_count', 'columns')
+
+
+def _read_json(path):
+    """Contents of a legacy json file, {} when missing or unreadable"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"Could not read {path}, skipping it")
+        return {}
+
+
+class Catalog:
+    """
+    SQLite store for every piece of table metadata: ingest summaries, statistical profiles,
+    llm column descriptions, the published (complete) profiles the schema context is built from,
+    the pipeline stage fingerprints, the per-column description cache and the rollup tables.
+
+    Rows are keyed by table (and column), so updating one table only rewrites that table's rows,
+    each inside its own transaction. Publishing a profile bumps a generation counter in the same
+    transaction, which is the schema version: the schema context only has to read that counter
+    to know whether it's current.
+
+    On first open the legacy json files (if given) are imported.
+    """
+    def __init__(self, db_path='catalog.db', summary_file=None, profile_file=None, llm_profile_dir=None,
+                 complete_file=None, state_file=None, description_cache_file=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_id', ?)", (uuid.uuid4().hex[:8],))
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', '0')")
+        self._migrate(summary_file, profile_file, llm_profile_dir, complete_file, state_file, description_cache_file)
+
+    #------ connections ------
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            #autocommit mode, transactions are opened explicitly
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction, BEGIN IMMEDIATE so concurrent writers queue up instead of failing on upgrade"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        return self._conn().execute(sql, params).fetchall()
+
+    #------ versions ------
+    def generation(self) -> int:
+        """Counter bumped every time a published profile changes"""
+        return int(self._query("SELECT value FROM meta WHERE key='generation'")[0][0])
+
+    def version(self) -> str:
+        """Schema version: the generation, qualified by this catalog's id so a recreated catalog never reuses one"""
+        rows = dict(self._query("SELECT key, value FROM meta WHERE key IN ('catalog_id', 'generation')"))
+        return f"{rows['catalog_id']}-{rows['generation']}"
+
+    #------ ingest summaries ------
+    def put_summaries(self, summaries: dict):
+        """Stores {table_name: summary} from DatabaseSetup.get_database_summary"""
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO table_summaries (table_name, summary) VALUES (?, ?)",
+                             [(table_name, json.dumps(summary, default=str)) for table_name, summary in summaries.items()])
+
+    def summaries(self) -> dict:
+        return {table_name: json.loads(summary)
+                for table_name, summary in self._query("SELECT table_name, summary FROM table_summaries ORDER BY rowid")}
+
+    #------ statistical profiles ------
+    def put_stats(self, table_name, profile: dict):
+        """Replaces the statistical profile of one table"""
+        extra = {key: value for key, value in profile.items() if key not in PROFILE_KEYS}
+        with self._transaction() as conn:
+            conn.execute("""INSERT INTO table_stats (table_name, row_count, extra, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(table_name) DO UPDATE SET row_count=excluded.row_count,
+                            extra=excluded.extra, updated_at=excluded.updated_at""",
+                         (table_name, profile['row_count'], json.dumps(extra), time.time()))
+            conn.execute("DELETE FROM column_stats WHERE table_name=?", (table_name,))
+            conn.executemany("INSERT INTO column_stats (table_name, column_name, position, stats) VALUES (?, ?, ?, ?)",
+                             [(table_name, col_name, position, json.dumps(col_data, default=str))
+                              for position, (col_name, col_data) in enumerate(profile['columns'].items())])
+
+    def get_stats(self, table_name):
+        """Statistical profile of a table in the DatabaseProfiler shape, or None"""
+        rows = self._query("SELECT row_count, extra FROM table_stats WHERE table_name=?", (table_name,))
+        if not rows:
+            return None
+        columns = self._query("SELECT column_name, stats FROM column_stats WHERE table_name=? ORDER BY position",
+                              (table_name,))
+        return {'table_name': table_name, 'row_count': rows[0][0], **json.loads(rows[0][1]),
+                'columns': {col_name: json.loads(stats) for col_name, stats in columns}}
+
+    #------ llm descriptions ------
+    def put_llm(self, table_name, descriptions: dict):
+        """Replaces the llm descriptions ({column: {short_description, long_description}}) of one table"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM column_llm WHERE table_name=?", (table_name,))
+            conn.executemany("""INSERT INTO column_llm (table_name, column_name, short_description, long_description)
+                                VALUES (?, ?, ?, ?)""",
+                             [(table_name, col_name, entry.get('short_description'), entry.get('long_description'))
+                              for col_name, entry in descriptions.items()])
+
+    def get_llm(self, table_name) -> dict:
+        rows = self._query("""SELECT column_name, short_description, long_description FROM column_llm
+                              WHERE table_name=? ORDER BY rowid""", (table_name,))
+        return {col_name: {'short_description': short, 'long_description': long}
+                for col_name, short, long in rows}
+
+    #------ published (complete) profiles ------
+    def publish(self, table_name, profile: dict):
+        """Replaces the complete profile of one table and bumps the generation"""
+        extra = {key: value for key, value in profile.items() if key not in PROFILE_KEYS}
+        with self._transaction() as conn:
+            #upsert keeps the table's original position in the schema
+            conn.execute("""INSERT INTO published_tables (table_name, row_count, extra, published_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(table_name) DO UPDATE SET row_count=excluded.row_count,
+                            extra=excluded.extra, published_at=excluded.published_at""",
+                         (table_name, profile['row_count'], json.dumps(extra), time.time()))
+            conn.execute("DELETE FROM published_columns WHERE table_name=?", (table_name,))
+            conn.executemany("INSERT INTO published_columns (table_name, column_name, position, profile) VALUES (?, ?, ?, ?)",
+                             [(table_name, col_name, position, json.dumps(col_data, default=str))
+                              for position, (col_name, col_data) in enumerate(profile['columns'].items())])
+            conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key='generation'")
+
+    def published_snapshot(self):
+        """(version, published_profiles(), rollups()) read from one consistent snapshot"""
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            return self.version(), self.published_profiles(), self.rollups()
+        finally:
+            conn.execute("COMMIT")
+
+    def get_published(self, table_name):
+        profiles = self.published_profiles([table_name])
+        return profiles.get(table_name)
+
+    def published_profiles(self, table_names=None) -> dict:
+        """Complete profiles {table: {table_name, row_count, columns}}, all tables unless `table_names` is given"""
+        tables = self._query("SELECT table_name, row_count, extra FROM published_tables ORDER BY rowid")
+        if table_names is not None:
+            tables = [row for row in tables if row[0] in table_names]
+        profiles = {}
+        for table_name, row_count, extra in tables:
+            columns = self._query("""SELECT column_name, profile FROM published_columns
+                                     WHERE table_name=? ORDER BY position""", (table_name,))
+            profiles[table_name] = {'table_name': table_name, 'row_count': row_count, **json.loads(extra),
+                                    'columns': {col_name: json.loads(profile) for col_name, profile in columns}}
+        return profiles
+
+    #------ pipeline stage fingerprints ------
+    def record_stage(self, table_name, stage, input_fp, output_fp):
+        with self._transaction() as conn:
+            conn.execute("""INSERT OR REPLACE INTO pipeline_state (table_name, stage, input_fp, output_fp, completed_at)
+                            VALUES (?, ?, ?, ?, ?)""", (table_name, stage, input_fp, output_fp, time.time()))
+
+    def table_state(self, table_name) -> dict:
+        """{stage: {input, output, completed_at}} of one table"""
+        rows = self._query("SELECT stage, input_fp, output_fp, completed_at FROM pipeline_state WHERE table_name=?",
+                           (table_name,))
+        return {stage: {'input': input_fp, 'output': output_fp, 'completed_at': completed_at}
+                for stage, input_fp, output_fp, completed_at in rows}
+
+    #------ per-column description cache ------
+    def cached_description(self, table_name, col_name, profile_fp):
+        """Cached description dict, or None when missing or described from different statistics"""
+        rows = self._query("""SELECT short_description, long_description FROM description_cache
+                              WHERE table_name=? AND column_name=? AND fingerprint=?""",
+                           (table_name, col_name, profile_fp))
+        if not rows:
+            return None
+        return {'short_description': rows[0][0], 'long_description': rows[0][1]}
+
+    def cache_descriptions(self, table_name, descriptions: dict, fingerprints: dict):
+        """Stores {col_name: description}, each under its column's profile fingerprint"""
+        with self._transaction() as conn:
+            conn.executemany("""INSERT OR REPLACE INTO description_cache
+                                (table_name, column_name, fingerprint, short_description, long_description)
+                                VALUES (?, ?, ?, ?, ?)""",
+                             [(table_name, col_name, fingerprints[col_name],
+                               entry.get('short_description'), entry.get('long_description'))
+                              for col_name, entry in descriptions.items()])
+
+    #------ rollups ------
+    def put_rollup(self, rollup_name, source_table, definition: dict, row_count, watermark):
+        """Records a refreshed rollup table, bumping the generation when its definition or row count changed"""
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT definition, row_count FROM rollups WHERE rollup_name=?", (rollup_name,)).fetchall()
+            conn.execute("""INSERT OR REPLACE INTO rollups (rollup_name, source_table, definition, row_count, watermark,
+                            refreshed_at) VALUES (?, ?, ?, ?, ?, ?)""",
+                         (rollup_name, source_table, json.dumps(definition, sort_keys=True), row_count, watermark,
+                          time.time()))
+            #the schema context shows both
+            if not rows or json.loads(rows[0][0]) != definition or rows[0][1] != row_count:
+                conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key='generation'")
+
+    def delete_rollup(self, rollup_name):
+        with self._transaction() as conn:
+            if conn.execute("DELETE FROM rollups WHERE rollup_name=?", (rollup_name,)).rowcount:
+                conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key='generation'")
+
+    def rollups(self) -> dict:
+        """{rollup_name: {source_table, definition, row_count, watermark, refreshed_at}}"""
+        rows = self._query("""SELECT rollup_name, source_table, definition, row_count, watermark, refreshed_at
+                              FROM rollups ORDER BY rowid""")
+        return {rollup_name: {'source_table': source_table, 'definition': json.loads(definition),
+                              'row_count': row_count, 'watermark': watermark, 'refreshed_at': refreshed_at}
+                for rollup_name, source_table, definition, row_count, watermark, refreshed_at in rows}
+
+    #------ legacy json import ------
+    def _migrate(self, summary_file, profile_file, llm_profile_dir, complete_file, state_file, description_cache_file):
+        """Imports the json metadata files once, when the catalog is first created"""
+        if self._query("SELECT 1 FROM meta WHERE key='migrated'"):
+            return
+        summaries = _read_json(summary_file)
+        if summaries:
+            self.put_summaries(summaries)
+        for table_name, profile in _read_json(profile_file).items():
+            self.put_stats(table_name, profile)
+        if llm_profile_dir and os.path.isdir(llm_profile_dir):
+            for file_name in sorted(os.listdir(llm_profile_dir)):
+                if file_name.endswith('.json'):
+                    descriptions = _read_json(os.path.join(llm_profile_dir, file_name))
+                    self.put_llm(file_name[:-len('.json')], {col_name: entry for col_name, entry in descriptions.items()
+                                                             if isinstance(entry, dict)})
+        for table_name, profile in _read_json(complete_file).items():
+            self.publish(table_name, profile)
+        for table_name, stages in _read_json(state_file).items():
+            for stage, entry in stages.items():
+                self.record_stage(table_name, stage, entry.get('input'), entry.get('output'))
+        for key, entry in _read_json(description_cache_file).items():
+            table_name, _, col_name = key.partition('.')
+            self.cache_descriptions(table_name, {col_name: entry['description']}, {col_name: entry['fingerprint']})
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
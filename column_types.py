@@ -0,0 +1,104 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+#sqlite declared type of each detected column type
+DECLARED_TYPES = {
+    'timestamp': 'TIMESTAMP',
+    'integer': 'INTEGER',
+    'decimal': 'REAL',
+    'boolean': 'BOOLEAN',
+}
+#timestamps are stored as ISO-8601 text in UTC, which sorts and compares like the time itself
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+ISO_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+SLASH_TIMESTAMP = re.compile(r'^\d{1,2}/\d{1,2}/\d{4}( \d{1,2}:\d{2}(:\d{2})?( ?[AaPp][Mm])?)?$')
+BOOLEAN_VALUES = {'true': 1, 'false': 0, 'yes': 1, 'no': 0, 't': 1, 'f': 0, 'y': 1, 'n': 0}
+#day and month bucket columns added next to every timestamp column
+DERIVED_SUFFIXES = {'_day': 10, '_month': 7}
+DETECTION_SAMPLE = 10000
+
+
+def infer_column_type(series: pd.Series):
+    """
+    Detects what a column holds from its non-null values.
+
+    Args:
+        - series: the column as read from the csv
+
+    Returns:
+        - one of 'timestamp', 'integer', 'decimal', 'boolean' or None for plain text
+    """
+    values = series.dropna()
+    if values.empty:
+        return None
+    if pd.api.types.is_bool_dtype(values):
+        return 'boolean'
+    if pd.api.types.is_numeric_dtype(values):
+        if pd.api.types.is_integer_dtype(values) or bool(np.all(np.mod(values.to_numpy(dtype=np.float64), 1) == 0)):
+            return 'integer'
+        return 'decimal'
+
+    if len(values) > DETECTION_SAMPLE:
+        values = values.sample(DETECTION_SAMPLE, random_state=0)
+    if values.map(lambda value: isinstance(value, bool)).all():
+        return 'boolean'
+    text = values.astype(str).str.strip()
+    if text.str.lower().isin(BOOLEAN_VALUES.keys()).all():
+        return 'boolean'
+    if timestamp_format(text) is not None:
+        return 'timestamp'
+    return None
+
+
+def timestamp_format(text: pd.Series):
+    """pandas parsing format of a column whose every value is a date/time, else None"""
+    if text.str.match(ISO_TIMESTAMP).all():
+        fmt = 'ISO8601'
+    elif text.str.match(SLASH_TIMESTAMP).all():
+        fmt = 'mixed'
+    else:
+        return None
+    parsed = pd.to_datetime(text, format=fmt, utc=True, errors='coerce')
+    return fmt if parsed.notna().all() else None
+
+
+def to_storage(series: pd.Series, column_type: str) -> pd.Series:
+    """
+    Converts one column to its native stored form, missing values become None (NULL).
+    Values that don't fit the type (a later chunk of a streamed file) are kept as they were.
+    """
+    if column_type == 'timestamp':
+        text = series.astype(object).where(series.notna(), None)
+        stripped = text.map(lambda value: value.strip() if isinstance(value, str) else value)
+        parsed = pd.to_datetime(stripped, format='ISO8601', utc=True, errors='coerce')
+        other = parsed.isna() & stripped.notna()
+        if other.any():
+            parsed[other] = pd.to_datetime(stripped[other], format='mixed', utc=True, errors='coerce')
+        converted = parsed.dt.strftime(TIMESTAMP_FORMAT).astype(object)
+        return converted.where(parsed.notna(), text)
+    if column_type == 'boolean':
+        def to_flag(value):
+            if isinstance(value, (bool, np.bool_)):
+                return int(value)
+            if isinstance(value, str):
+                return BOOLEAN_VALUES.get(value.strip().lower(), value)
+            return value
+        return series.astype(object).map(to_flag).where(series.notna(), None)
+    return series.astype(object).where(series.notna(), None)
+
+
+def derived_columns(column_types: dict):
+    """{derived column: (timestamp column, prefix length)} of the day/month bucket columns"""
+    return {f"{column}{suffix}": (column, length)
+            for column, column_type in column_types.items() if column_type == 'timestamp'
+            for suffix, length in DERIVED_SUFFIXES.items()}
+
+
+def add_derived_columns(frame: pd.DataFrame, derived: dict) -> pd.DataFrame:
+    """Adds the day ('YYYY-MM-DD') and month ('YYYY-MM') buckets of the converted timestamp columns"""
+    for name, (column, length) in derived.items():
+        frame[name] = frame[column].map(
+            lambda value: value[:length] if isinstance(value, str) and ISO_TIMESTAMP.match(value) else None)
+    return frame
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class ReadOnlyConnectionPool:
+    """
+    Hands out one read-only sqlite connection per thread and reuses it across queries.
+
+    Connections are opened with the `mode=ro` URI and `query_only`, so they can never write.
+    The database runs in WAL mode (DatabaseSetup switches it on), which lets these readers
+    keep running against the last committed snapshot while an ingest writes new tables.
+    """
+    def __init__(self, db_path='cloud_costs.db', cache_size_kib=65536, mmap_size=268435456):
+        self.db_path = db_path
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._generation = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens a new read-only connection with the read-side pragmas applied"""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        #check_same_thread is off only so close_all() can close it, each connection is used by its own thread
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        logger.info(f"Opened read-only connection to {self.db_path} for {threading.current_thread().name}")
+        return conn
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection, opening it on first use or after a reset"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.generation == self._generation:
+            return conn
+        if conn is not None:
+            self._discard(conn)
+
+        conn = self._connect()
+        with self._lock:
+            self._connections.add(conn)
+        self._local.conn = conn
+        self._local.generation = self._generation
+        return conn
+
+    def open_connection(self) -> sqlite3.Connection:
+        """Opens a dedicated read-only connection outside the per-thread pool, the caller closes it"""
+        return self._connect()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+        self._local.conn = None
+
+    def reset(self):
+        """Makes every thread reopen its connection on next use (e.g. after the db file was replaced)"""
+        with self._lock:
+            self._generation += 1
+
+    def close_all(self):
+        """Closes every pooled connection"""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+            self._generation += 1
+        for conn in connections:
+            conn.close()
@@ -2,16 +2,40 @@ import pandas as pd
 import numpy as np
 # from datasketch import MinHash, MinHashLSH
 import sqlite3
-from collections import defaultdict
+import threading
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from approx_profiling import ApproximateProfiler
 
 class DatabaseProfiler:
-    def __init__(self,table_map, db_path='cloud_costs.db'):
+    def __init__(self,table_map, db_path='cloud_costs.db', approx_threshold_rows=None, table_modes=None,
+                 approx_chunk_rows=100000, read_only=False, executor=None, parallel_group_columns=16):
         """
         Init the db profiler
+
+        Args:
+            - approx_threshold_rows: tables with more rows than this are profiled approximately (None: never)
+            - table_modes: optional {table_name: "exact" | "approximate"} overriding the threshold
+            - approx_chunk_rows: rows streamed at a time by the approximate profiler
+            - read_only: open the db with a `mode=ro` connection
+            - executor: optional process pool the column groups / approximate tables are profiled on
+            - parallel_group_columns: columns per worker task when an executor is given
         """
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
+        self.approx_threshold_rows = approx_threshold_rows
+        self.table_modes = table_modes or {}
+        self.approx_chunk_rows = approx_chunk_rows
+        self.executor = executor
+        self.parallel_group_columns = parallel_group_columns
+        if read_only:
+            self.conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+        else:
+            #shared by the threads of profile_all_tables(workers=...), which only run small queries on it
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
         self.profile_map={}
         # self.tables=[
         #     'aws_cost_usage',
@@ -19,65 +43,239 @@ class DatabaseProfiler:
         # ]
         self.tables=table_map
     
-    def profile_all_tables(self):
-        """Returns the statistical profiling of all tables."""
-        for table_name in self.tables:
-            self.profile_map[table_name]=self.profile_table(table_name=table_name)
+    def profile_all_tables(self, workers=None):
+        """
+        Returns the statistical profiling of all tables.
+        With `workers` > 1 the tables and column groups of wide tables are spread over a process pool.
+        """
+        if not workers or workers <= 1:
+            for table_name in self.tables:
+                self.profile_map[table_name]=self.profile_table(table_name=table_name)
+            return self.profile_map
+
+        with profiling_process_pool(workers) as executor:
+            self.executor = executor
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, len(self.tables))) as threads:
+                    futures = {table_name: threads.submit(self.profile_table, table_name) for table_name in self.tables}
+                    for table_name in self.tables:
+                        self.profile_map[table_name] = futures[table_name].result()
+            finally:
+                self.executor = None
         return self.profile_map
     
 
+    COLUMNS_PER_QUERY = 50 #columns aggregated per statistics query
+    SAMPLE_SIZE = 10
+    PATTERN_SAMPLE_SIZE = 10000 #values per column the string patterns are computed on
+
+    #(pattern, regex) in priority order, a value gets the first pattern it matches
+    PATTERNS = [
+        ('json', r'(?s)^\s*(?:\{.*\}|\[.*\])\s*$'),
+        ('aws_arn', r'^arn:aws[a-z-]*:[^:]*:'),
+        ('azure_resource_id', r'(?i)^/(?:subscriptions|providers)/'),
+        ('uuid', r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'),
+        ('iso_timestamp', r'^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?$'),
+    ]
+    #iso 4217 codes seen in billing exports, checked after PATTERNS (a bare [A-Z]{3} would also match e.g. AWS)
+    CURRENCY_CODES = frozenset('''
+        USD EUR GBP JPY CNY INR AUD CAD CHF SEK NOK DKK NZD SGD HKD KRW TWD BRL MXN ZAR
+        RUB TRY PLN CZK HUF ILS AED SAR THB IDR MYR PHP VND CLP COP ARS PEN EGP NGN KES
+    '''.split())
+
+    @staticmethod
+    def _quote(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _column_aggregates(self, column):
+        """Aggregate expressions computing one column's statistics inside sqlite"""
+        col = self._quote(column)
+        return [
+            f"COUNT({col})",
+            f"COUNT(DISTINCT {col})",
+            f"SUM(typeof({col}) = 'integer')",
+            f"SUM(typeof({col}) = 'real')",
+            f"SUM(typeof({col}) IN ('text', 'blob'))",
+            f"MIN(CASE WHEN typeof({col}) IN ('integer', 'real') THEN {col} END)",
+            f"MAX(CASE WHEN typeof({col}) IN ('integer', 'real') THEN {col} END)",
+            f"MIN(LENGTH({col}))",
+            f"MAX(LENGTH({col}))",
+        ]
+
+    @staticmethod
+    def _pandas_dtype(row_count, non_null, integers, reals, texts):
+        """The dtype pandas would infer when reading the column, from the sqlite storage classes"""
+        if texts or not non_null:
+            return 'object'
+        if reals or non_null < row_count:
+            #an integer column with nulls is read as float64
+            return 'float64'
+        return 'int64'
+
+    def profile_mode(self, table_name):
+        """'exact' or 'approximate', from the per-table override or the row count threshold"""
+        if table_name in self.table_modes:
+            return self.table_modes[table_name]
+        if self.approx_threshold_rows is None:
+            return 'exact'
+        #MAX(rowid) is an index lookup, COUNT(*) would scan the table
+        with self._lock:
+            estimated_rows = self.conn.execute(f"SELECT MAX(rowid) FROM {self._quote(table_name)}").fetchone()[0] or 0
+        return 'approximate' if estimated_rows > self.approx_threshold_rows else 'exact'
+
     def profile_table(self, table_name):
-        """Basic table profiling from an sql db"""
+        """
+        Basic table profiling, computed inside sqlite.
+        Tables over the approximate threshold go to `ApproximateProfiler` instead.
+
+        The statistics come from aggregate queries over groups of `COLUMNS_PER_QUERY` columns and the
+        samples from `LIMIT`ed queries, so the table is never loaded into memory.
+        The output has the same shape and values as profiling the table with pandas.
+        With an `executor` the column groups (`parallel_group_columns` wide) are profiled in worker processes.
+        """
         print(table_name)
-        print("ALL TABLES:")
-        df_tables = pd.read_sql("SELECT name FROM sqlite_master WHERE type='table'", self.conn)
-        print(df_tables)
-        print("="*50)        
-        df = pd.read_sql(f"SELECT * FROM {table_name}", self.conn)
-        
-        profile = {
+        if self.profile_mode(table_name) == 'approximate':
+            if self.executor is not None:
+                return self.executor.submit(profile_table_worker, self.db_path, table_name,
+                                            self.worker_options()).result()
+            approx_profiler = ApproximateProfiler(self.conn, chunk_rows=self.approx_chunk_rows)
+            return approx_profiler.profile_table(table_name, self._extract_patterns)
+
+        with self._lock:
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({self._quote(table_name)})")]
+        if self.executor is None:
+            fragments = [self.profile_columns(table_name, columns)]
+        else:
+            width = self.parallel_group_columns
+            futures = [self.executor.submit(profile_columns_worker, self.db_path, table_name, columns[i:i + width])
+                       for i in range(0, len(columns), width)]
+            fragments = [future.result() for future in futures]
+        return self.merge_fragments(table_name, columns, fragments)
+
+    @staticmethod
+    def merge_fragments(table_name, columns, fragments):
+        """Joins column fragments into one profile, columns in table order whatever order the fragments finished in"""
+        merged = {}
+        for fragment in fragments:
+            merged.update(fragment['columns'])
+        return {
             'table_name': table_name,
-            'row_count': int(len(df)),  # Convert to native int
-            'columns': {}
+            'row_count': fragments[0]['row_count'] if fragments else 0,
+            'columns': {column: merged[column] for column in columns},
         }
-        
-        for column in df.columns:
-            col_data = df[column]
-
-            profile['columns'][column] = {
-                'null_count': int(col_data.isnull().sum()),  # Convert to native int
-                'distinct_count': int(col_data.nunique()),   # Convert to native int
-                'data_type': str(col_data.dtype),
-                'sample_values': col_data.dropna().head(10).tolist(),
-                'min_value': float(col_data.min()) if col_data.dtype in [np.int64, np.float64] else None,  # Convert to float
-                'max_value': float(col_data.max()) if col_data.dtype in [np.int64, np.float64] else None,  # Convert to float
-            }
-            
-            # String-specific profiling
-            if col_data.dtype == 'object':
-                str_lengths = col_data.dropna().astype(str).str.len()
-                profile['columns'][column].update({
-                    'min_length': int(str_lengths.min()) if len(str_lengths) > 0 else None,  # Convert to int
-                    'max_length': int(str_lengths.max()) if len(str_lengths) > 0 else None,  # Convert to int
-                    'common_patterns': self._extract_patterns(col_data)
-                })
-        
-        return profile
+
+    def profile_columns(self, table_name, columns):
+        """
+        Profiles some columns of a table.
+
+        Returns:
+            - fragment: {"row_count", "columns": {column: stats}}
+        """
+        table = self._quote(table_name)
+        fragment = {'row_count': 0, 'columns': {}}
+        if not columns:
+            fragment['row_count'] = int(self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0])
+            return fragment
+
+        text_counts = {}
+        for start in range(0, len(columns), self.COLUMNS_PER_QUERY):
+            group = columns[start:start + self.COLUMNS_PER_QUERY]
+            expressions = [expr for column in group for expr in self._column_aggregates(column)]
+            #the row count rides along in the same scan
+            values = self.conn.execute(f"SELECT COUNT(*), {', '.join(expressions)} FROM {table}").fetchone()
+            row_count, values = values[0], values[1:]
+            fragment['row_count'] = int(row_count)
+            width = len(expressions) // len(group)
+            for i, column in enumerate(group):
+                (non_null, distinct, integers, reals, texts, min_value, max_value,
+                 min_length, max_length) = values[i * width:(i + 1) * width]
+                data_type = self._pandas_dtype(row_count, non_null, integers, reals, texts)
+                numeric = data_type != 'object'
+                fragment['columns'][column] = {
+                    'null_count': int(row_count - non_null),
+                    'distinct_count': int(distinct),
+                    'data_type': data_type,
+                    'sample_values': self._sample_values(table, column, data_type) if non_null else [],
+                    'min_value': float(min_value) if numeric and min_value is not None else None,
+                    'max_value': float(max_value) if numeric and max_value is not None else None,
+                }
+
+                # String-specific profiling
+                if not numeric:
+                    fragment['columns'][column].update({
+                        'min_length': int(min_length) if min_length is not None else None,
+                        'max_length': int(max_length) if max_length is not None else None,
+                        'common_patterns': {},
+                    })
+                    text_counts[column] = texts
+
+        #patterns come from one evenly spread sample of the text columns, scaled to the full counts
+        if text_counts:
+            sample = self._pattern_sample(table, list(text_counts), fragment['row_count'])
+            for column, texts in text_counts.items():
+                values = sample[column].dropna()
+                patterns = self._extract_patterns(values)
+                scale = texts / len(values) if len(values) else 0
+                fragment['columns'][column]['common_patterns'] = {
+                    name: int(round(count * scale)) for name, count in patterns.items()
+                }
+
+        return fragment
+
+    def worker_options(self):
+        """Constructor options a worker process needs to profile like this profiler"""
+        return {'approx_threshold_rows': self.approx_threshold_rows, 'table_modes': self.table_modes,
+                'approx_chunk_rows': self.approx_chunk_rows}
+
+    def _pattern_sample(self, table, columns, row_count):
+        """Every k-th row of `columns`, about `PATTERN_SAMPLE_SIZE` rows in total (the whole table when smaller)"""
+        stride = max(1, row_count // self.PATTERN_SAMPLE_SIZE)
+        where = f"WHERE rowid % {stride} = 0" if stride > 1 else ""
+        query = f"SELECT {', '.join(self._quote(column) for column in columns)} FROM {table} {where} LIMIT {self.PATTERN_SAMPLE_SIZE}"
+        return pd.read_sql(query, self.conn)
+
+    def _sample_values(self, table, column, data_type):
+        """First `SAMPLE_SIZE` non-null values of a column"""
+        col = self._quote(column)
+        rows = self.conn.execute(
+            f"SELECT {col} FROM {table} WHERE {col} IS NOT NULL LIMIT {self.SAMPLE_SIZE}").fetchall()
+        if data_type == 'float64':
+            return [float(row[0]) for row in rows]
+        return [row[0] for row in rows]
     
-    def _extract_patterns(self, series):
-        """Extract common patterns from string data"""
-        # Implement pattern detection (digits, uppercase, special chars, etc.)
-        patterns = defaultdict(int)
-        for value in series.dropna():
-            if isinstance(value, str):
-                # Simple pattern categorization
-                if value.isdigit():
-                    patterns['all_digits'] += 1
-                elif value.isalpha():
-                    patterns['all_letters'] += 1
-                elif any(c.isdigit() for c in value) and any(c.isalpha() for c in value):
-                    patterns['alphanumeric'] += 1
-        return dict(patterns)
+    def _extract_patterns(self, series, max_values=None):
+        """
+        Counts the string values of a series per pattern class (see `PATTERNS`, then currency_code,
+        all_digits, all_letters and alphanumeric), vectorized over the distinct values.
+        Series longer than `max_values` (default `PATTERN_SAMPLE_SIZE`) are sampled and the counts scaled.
+        """
+        values = series.dropna()
+        max_values = max_values or self.PATTERN_SAMPLE_SIZE
+        scale = 1.0
+        if len(values) > max_values:
+            scale = len(values) / max_values
+            values = values.sample(n=max_values, random_state=0)
+
+        #classify each distinct value once and weight it by its count
+        counts = values.value_counts(sort=False)
+        is_str = np.fromiter((isinstance(value, str) for value in counts.index), dtype=bool, count=len(counts))
+        counts = counts[is_str]
+        if counts.empty:
+            return {}
+        text = pd.Series(counts.index, dtype=object).str
+
+        names = [name for name, _ in self.PATTERNS] + ['currency_code', 'all_digits', 'all_letters', 'alphanumeric']
+        conditions = [text.contains(regex, regex=True).to_numpy(dtype=bool) for _, regex in self.PATTERNS]
+        conditions += [
+            text.strip().str.upper().isin(self.CURRENCY_CODES).to_numpy(dtype=bool),
+            text.isdigit().to_numpy(dtype=bool),
+            text.isalpha().to_numpy(dtype=bool),
+            (text.contains(r'\d', regex=True) & text.contains(r'[^\W\d_]', regex=True)).to_numpy(dtype=bool),
+        ]
+        labels = np.select(conditions, np.arange(len(names)), default=-1)
+        totals = np.bincount(labels[labels >= 0], weights=counts.to_numpy()[labels >= 0], minlength=len(names))
+
+        return {name: int(round(total * scale)) for name, total in zip(names, totals) if total}
     
     # def create_minhash_index(self, table_name, column_name, num_perm=128):
     #     """Create MinHash sketches for similarity detection"""
@@ -97,6 +295,28 @@ class DatabaseProfiler:
     #     return lsh, minhashes
     
 
+#------ process pool workers (top level so they can be pickled) ------
+def profile_columns_worker(db_path, table_name, columns):
+    """Profiles a column group on the worker's own read-only connection, returns a picklable fragment"""
+    profiler = DatabaseProfiler([table_name], db_path=db_path, read_only=True)
+    try:
+        return profiler.profile_columns(table_name, columns)
+    finally:
+        profiler.conn.close()
+
+def profile_table_worker(db_path, table_name, options):
+    """Profiles a whole table (the approximate mode streams it in one pass) on its own read-only connection"""
+    profiler = DatabaseProfiler([table_name], db_path=db_path, read_only=True, **options)
+    try:
+        return profiler.profile_table(table_name)
+    finally:
+        profiler.conn.close()
+
+def profiling_process_pool(workers):
+    """Process pool for profiling, spawned so the workers don't inherit the api's threads and connections"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
 if __name__=="__main__":
     profiler=DatabaseProfiler()
     total_profile=profiler.profile_all_tables()
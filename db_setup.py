@@ -3,12 +3,16 @@ import pandas as pd
 import os
 from pathlib import Path
 import logging
+from contextlib import contextmanager
 from typing import Dict, List, Optional
 
+from column_types import DECLARED_TYPES, infer_column_type, to_storage, derived_columns, add_derived_columns
+
 logger = logging.getLogger(__name__)
 
 class DatabaseSetup:
-    def __init__(self,required_data_map,dir_path='uploads', db_path='cloud_costs.db'):
+    def __init__(self,required_data_map,dir_path='uploads', db_path='cloud_costs.db', result_cache=None, chunk_rows=None,
+                 load_cache_kib=262144, typed_columns=True):
         self.db_path = db_path
         self.data_dir = Path(dir_path)
         # self.required_data_map = {
@@ -18,6 +22,15 @@ class DatabaseSetup:
         self.required_data_map=required_data_map
         self.conn = None
         self.loaded_tables = {}
+        #optional ResultCache, told about every table this setup rewrites
+        self.result_cache = result_cache
+        #when set, csv files are streamed in chunks of this many rows instead of read whole
+        self.chunk_rows = chunk_rows
+        #page cache used while bulk loading (KiB)
+        self.load_cache_kib = load_cache_kib
+        #store timestamp/integer/decimal/boolean columns natively (NULL when missing) with day/month buckets
+        #instead of filling every null with 0 or 'Unknown'
+        self.typed_columns = typed_columns
     
     def check_data_files(self) -> Dict[str, bool]:
         """Check which required data files exist"""
@@ -41,6 +54,8 @@ class DatabaseSetup:
         """Create database connection"""
         try:
             self.conn = sqlite3.connect(self.db_path)
+            #WAL lets the api's read-only connections keep reading while tables are rewritten
+            self.conn.execute("PRAGMA journal_mode=WAL")
             logger.info(f"Connected to database: {self.db_path}")
             return True
         except sqlite3.Error as e:
@@ -63,8 +78,14 @@ class DatabaseSetup:
         logger.info(f"Successfully loaded {success_count} out of {len(existing_files)} datasets")
         return success_count > 0
     
+    def load_table(self, table_name: str, file_path: Path) -> bool:
+        """Load one CSV file into its table (the connection must already be open)"""
+        return self._load_single_dataset(table_name, file_path)
+
     def _load_single_dataset(self, table_name: str, file_path: Path) -> bool:
         """Load a single CSV file into database table"""
+        if self.chunk_rows:
+            return self._load_single_dataset_chunked(table_name, file_path)
         try:
             logger.info(f"Loading {table_name} from {file_path.name}")
             
@@ -75,14 +96,23 @@ class DatabaseSetup:
             #cleans the dataframe
             df_cleaned = self.clean_dataframe(df, file_path.name)
             
-            #loads into the db
-            df_cleaned.to_sql(table_name, self.conn, if_exists='replace', index=False)
+            #loads into a staging table, then swaps it in for the live one
+            with self._bulk_load_pragmas():
+                with self._transaction():
+                    insert_sql = self._create_staging(table_name, df_cleaned)
+                    self._insert_frame(insert_sql, df_cleaned)
+            self._swap_in(table_name)
+            
+            #cached query results over the old data are stale now
+            if self.result_cache is not None:
+                self.result_cache.invalidate_table(table_name)
             
             #places metadata into the loaded_tables dict
             self.loaded_tables[table_name] = {
                 'original_rows': len(df),
                 'cleaned_rows': len(df_cleaned),
                 'columns': list(df_cleaned.columns),
+                'column_types': df_cleaned.attrs.get('column_types', {}),
                 'file_source': file_path.name
             }
             
@@ -91,8 +121,184 @@ class DatabaseSetup:
             
         except Exception as e:
             logger.error(f"Failed to load {table_name}: {e}")
+            self._drop_staging(table_name)
             return False
     
+    @contextmanager
+    def _transaction(self, immediate=False):
+        """Runs the block inside one explicit transaction on `self.conn`"""
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    @contextmanager
+    def _bulk_load_pragmas(self):
+        """Load-time pragmas (no fsync per write, a large page cache), restored afterwards"""
+        synchronous = self.conn.execute("PRAGMA synchronous").fetchone()[0]
+        cache_size = self.conn.execute("PRAGMA cache_size").fetchone()[0]
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute(f"PRAGMA cache_size=-{self.load_cache_kib}")
+        try:
+            yield
+        finally:
+            self.conn.execute(f"PRAGMA synchronous={int(synchronous)}")
+            self.conn.execute(f"PRAGMA cache_size={int(cache_size)}")
+
+    @staticmethod
+    def staging_table(table_name: str) -> str:
+        """Name of the table a load writes into before it is swapped in"""
+        return f"{table_name}__staging"
+
+    def _create_staging(self, table_name: str, first_frame: pd.DataFrame) -> str:
+        """
+        (Re)creates the staging table with the schema of `first_frame`, returns its insert statement.
+        Typed columns (`first_frame.attrs['column_types']`) get their native declared type.
+        """
+        staging = self.staging_table(table_name)
+        column_types = first_frame.attrs.get('column_types', {})
+        self.conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+        self.conn.execute(pd.io.sql.get_schema(first_frame, staging, con=self.conn,
+                                               dtype={column: DECLARED_TYPES[column_type]
+                                                      for column, column_type in column_types.items()}))
+        placeholders = ', '.join('?' * len(first_frame.columns))
+        return f'INSERT INTO "{staging}" VALUES ({placeholders})'
+
+    def _insert_frame(self, insert_sql: str, frame: pd.DataFrame):
+        """Bulk-inserts a cleaned frame with one executemany"""
+        self.conn.executemany(insert_sql, frame.to_numpy(dtype=object).tolist())
+
+    def _swap_in(self, table_name: str):
+        """
+        Atomically replaces the live table with its staging table.
+
+        The live table's indexes are only built now, on the fully loaded data, and inside the
+        same transaction as the drop and rename, so readers see the old table until the commit.
+        """
+        staging = self.staging_table(table_name)
+        index_sql = [row[0] for row in self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table_name,))]
+        with self._transaction(immediate=True):
+            self.conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            self.conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+            for sql in index_sql:
+                try:
+                    self.conn.execute(sql)
+                except sqlite3.OperationalError as e:
+                    #the new file no longer has a column the index was on
+                    logger.warning(f"Could not recreate index on {table_name}: {e}")
+
+    def _drop_staging(self, table_name: str):
+        """Removes a staging table left behind by a failed load"""
+        try:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            self.conn.execute(f'DROP TABLE IF EXISTS "{self.staging_table(table_name)}"')
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Could not drop staging table for {table_name}: {e}")
+
+    def _load_single_dataset_chunked(self, table_name: str, file_path: Path) -> bool:
+        """
+        Stream a CSV file into a database table `chunk_rows` rows at a time.
+
+        The table schema (column names and which columns are numeric) is fixed from the first chunk,
+        every chunk gets the same cleaning and is bulk-inserted into the staging table in a single
+        transaction, which is then swapped in for the live table. Peak memory is one chunk.
+        Columns that turn out to be empty in the whole file are dropped at the end, like `clean_dataframe` does.
+        """
+        try:
+            logger.info(f"Streaming {table_name} from {file_path.name} in chunks of {self.chunk_rows} rows")
+            schema = None
+            original_rows = 0
+            cleaned_rows = 0
+            has_values = None
+
+            with self._bulk_load_pragmas(), self._transaction():
+                for chunk in pd.read_csv(file_path, chunksize=self.chunk_rows):
+                    original_rows += len(chunk)
+                    if schema is None:
+                        schema = self._chunk_schema(chunk)
+                        insert_sql = self._create_staging(table_name, self.clean_chunk(chunk, schema))
+                        has_values = pd.Series(False, index=schema['original'])
+
+                    has_values |= chunk.reindex(columns=schema['original']).notna().any()
+                    cleaned = self.clean_chunk(chunk, schema)
+                    self._insert_frame(insert_sql, cleaned)
+                    cleaned_rows += len(cleaned)
+
+                if schema is not None:
+                    staging = self.staging_table(table_name)
+                    empty = [name for name, present in zip(schema['names'], has_values) if not present]
+                    for name in empty:
+                        self.conn.execute(f'ALTER TABLE "{staging}" DROP COLUMN "{name}"')
+                    if empty:
+                        logger.info(f"Removed {len(empty)} empty columns: {empty}")
+                        schema['names'] = [name for name in schema['names'] if name not in empty]
+
+            if schema is None:
+                logger.error(f"{file_path.name} has no rows")
+                return False
+            self._swap_in(table_name)
+
+            if self.result_cache is not None:
+                self.result_cache.invalidate_table(table_name)
+
+            self.loaded_tables[table_name] = {
+                'original_rows': original_rows,
+                'cleaned_rows': cleaned_rows,
+                'columns': schema['names'] + list(schema['derived']),
+                'column_types': schema['types'],
+                'file_source': file_path.name
+            }
+            logger.info(f"Successfully loaded {table_name} ({cleaned_rows} rows)")
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to load {table_name}: {e}")
+            self._drop_staging(table_name)
+            return False
+
+    def _chunk_schema(self, first_chunk: pd.DataFrame) -> Dict:
+        """Fixes the column names, numeric columns and column types of a chunked load from its first chunk"""
+        names = [self.clean_column_name(col) for col in first_chunk.columns]
+        numeric = set(first_chunk.select_dtypes(include=['number']).columns)
+        types = {}
+        if self.typed_columns:
+            types = {name: column_type for col, name in zip(first_chunk.columns, names)
+                     if (column_type := infer_column_type(first_chunk[col])) is not None}
+        return {
+            'original': list(first_chunk.columns),
+            'names': names,
+            #columns that are empty in the first chunk can't be typed yet, they are treated as text
+            'numeric': [name for col, name in zip(first_chunk.columns, names)
+                        if col in numeric and first_chunk[col].notna().any()],
+            'types': types,
+            'derived': derived_columns(types),
+        }
+
+    def clean_chunk(self, chunk: pd.DataFrame, schema: Dict) -> pd.DataFrame:
+        """Same cleaning as `clean_dataframe` for one chunk, against the schema of the first chunk"""
+        chunk = chunk.reindex(columns=schema['original'])
+        chunk.columns = schema['names']
+        chunk = chunk.dropna(how='all')
+        types = schema['types']
+        numeric_cols = [name for name in schema['numeric'] if name not in types]
+        text_cols = [name for name in schema['names'] if name not in numeric_cols and name not in types]
+        chunk[numeric_cols] = chunk[numeric_cols].fillna(0)
+        chunk[text_cols] = chunk[text_cols].astype(object).fillna('Unknown')
+        if types:
+            for name, column_type in types.items():
+                chunk[name] = to_storage(chunk[name], column_type)
+            chunk = add_derived_columns(chunk, schema['derived'])
+            chunk.attrs['column_types'] = types
+        return chunk
+
     def clean_dataframe(self, df: pd.DataFrame, data_source: str) -> pd.DataFrame:
         """Clean and prepare dataframe for database storage"""
         logger.info(f"Cleaning {data_source} data")
@@ -109,14 +315,28 @@ class DatabaseSetup:
         # 3.Clean column names for SQL compatibility
         df_cleaned.columns = [self.clean_column_name(col) for col in df_cleaned.columns]
         
-        # 4. Fill numeric nulls with 0
-        numeric_cols = df_cleaned.select_dtypes(include=['number']).columns
+        # 4. Detect timestamp/integer/decimal/boolean columns, they keep NULL for missing values
+        column_types = {}
+        if self.typed_columns:
+            column_types = {col: column_type for col in df_cleaned.columns
+                            if (column_type := infer_column_type(df_cleaned[col])) is not None}
+        
+        # 5. Fill numeric nulls with 0
+        numeric_cols = [col for col in df_cleaned.select_dtypes(include=['number']).columns if col not in column_types]
         df_cleaned[numeric_cols] = df_cleaned[numeric_cols].fillna(0)
         
-        # 5. Fill text nulls with 'Unknown'
-        text_cols = df_cleaned.select_dtypes(include=['object']).columns
+        # 6. Fill text nulls with 'Unknown'
+        text_cols = [col for col in df_cleaned.select_dtypes(include=['object']).columns if col not in column_types]
         df_cleaned[text_cols] = df_cleaned[text_cols].fillna('Unknown')
         
+        # 7. Store the typed columns natively, timestamps as ISO-8601 with day/month bucket columns
+        if column_types:
+            for col, column_type in column_types.items():
+                df_cleaned[col] = to_storage(df_cleaned[col], column_type)
+            df_cleaned = add_derived_columns(df_cleaned, derived_columns(column_types))
+            df_cleaned.attrs['column_types'] = column_types
+            logger.info(f"Typed columns: {column_types}")
+        
         # Log cleaning results
         removed_cols = set(original_columns) - set(df_cleaned.columns)
         if removed_cols:
@@ -0,0 +1,309 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+
+from result_cache import canonicalize_sql
+from sql_guard import QueryRejected, QueryTimeout
+from sql_utils import query_column_usage
+
+logger = logging.getLogger(__name__)
+
+AUTO_INDEX_PREFIX = 'auto_idx_'
+
+
+class IndexAdvisor:
+    """
+    Creates and retires indexes on the data db from the queries that actually run against it.
+
+    Every executed statement is logged (canonical sql, run count, latency) in `log_db_path`.
+    `run()` then:
+        - replays the logged queries through EXPLAIN QUERY PLAN and keeps the ones that full-scan a table
+        - parses their WHERE/ON/GROUP BY columns into candidate indexes: equality columns first, then one
+          range column, or the equality columns followed by the group-by columns; single-column indexes for joins
+        - creates the candidates ranked by how often their queries ran, as `auto_idx_*` indexes, while the
+          total size of the auto indexes stays within `disk_budget_bytes`
+        - drops `auto_idx_*` indexes no logged query asks for any more
+        - times the affected queries before and after, which is the report
+    """
+    def __init__(self, db_path='cloud_costs.db', log_db_path='query_log.db', disk_budget_bytes=512 * 1024 * 1024,
+                 max_indexes_per_table=5, max_index_columns=3, window_seconds=7 * 24 * 3600, report_queries=10,
+                 guard=None):
+        self.db_path = db_path
+        self.guard = guard
+        self.log_db_path = log_db_path
+        self.disk_budget_bytes = disk_budget_bytes
+        self.max_indexes_per_table = max_indexes_per_table
+        self.max_index_columns = max_index_columns
+        self.window_seconds = window_seconds
+        self.report_queries = report_queries
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+        self.log_conn = sqlite3.connect(log_db_path, check_same_thread=False)
+        self.log_conn.execute("PRAGMA journal_mode=WAL")
+        self.log_conn.execute("PRAGMA synchronous=NORMAL")
+        self.log_conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_log (
+                query_key TEXT PRIMARY KEY,
+                sql TEXT NOT NULL,
+                runs INTEGER NOT NULL,
+                total_ms REAL NOT NULL,
+                last_ms REAL,
+                last_run REAL NOT NULL
+            )
+        """)
+        self.log_conn.commit()
+
+    #------ query log ------
+    def record(self, sql: str, elapsed_ms: float = None):
+        """Logs one execution of `sql` (elapsed_ms is None for a result cache hit)"""
+        key = hashlib.sha256(canonicalize_sql(sql).encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            self.log_conn.execute("""
+                INSERT INTO query_log (query_key, sql, runs, total_ms, last_ms, last_run) VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT(query_key) DO UPDATE SET runs = runs + 1, total_ms = total_ms + excluded.total_ms,
+                    last_ms = COALESCE(excluded.last_ms, last_ms), last_run = excluded.last_run
+            """, (key, sql, elapsed_ms or 0.0, elapsed_ms, time.time()))
+            self.log_conn.commit()
+
+    def logged_queries(self):
+        """[(sql, runs)] of the queries run within the window, most frequent first"""
+        with self._lock:
+            return self.log_conn.execute(
+                "SELECT sql, runs FROM query_log WHERE last_run >= ? ORDER BY runs DESC",
+                (time.time() - self.window_seconds,)).fetchall()
+
+    #------ plan inspection ------
+    @staticmethod
+    def scanned_tables(conn, sql):
+        """Tables the query plan reads with a full scan (no index)"""
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.Error:
+            return set()
+        scanned = set()
+        for row in plan:
+            detail = row[-1]
+            if detail.startswith('SCAN ') and 'INDEX' not in detail:
+                #"SCAN table" or "SCAN table AS alias"
+                scanned.add(detail.split()[1].strip('"'))
+        return scanned
+
+    @staticmethod
+    def plan_indexes(conn, sql):
+        """Names of the indexes the query plan uses"""
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.Error:
+            return set()
+        used = set()
+        for row in plan:
+            words = row[-1].split()
+            if 'INDEX' in words and words.index('INDEX') + 1 < len(words):
+                used.add(words[words.index('INDEX') + 1])
+        return used
+
+    #------ candidates ------
+    def _candidates(self, usage, scanned):
+        """Candidate (table, columns) indexes for one query"""
+        candidates = []
+        by_table = {}
+        for table, column, kind in usage:
+            if table in scanned or kind == 'join':
+                by_table.setdefault(table, []).append((column, kind))
+        for table, entries in by_table.items():
+            equality = [column for column, kind in entries if kind == 'eq']
+            ranges = [column for column, kind in entries if kind == 'range']
+            groups = [column for column, kind in entries if kind == 'group']
+            joins = [column for column, kind in entries if kind == 'join']
+            if equality or ranges:
+                candidates.append((table, tuple((equality + ranges[:1])[:self.max_index_columns])))
+            if groups:
+                candidates.append((table, tuple(dict.fromkeys(equality + groups))[:self.max_index_columns]))
+            for column in joins:
+                candidates.append((table, (column,)))
+        return candidates
+
+    @staticmethod
+    def _index_name(table, columns):
+        name = f"{AUTO_INDEX_PREFIX}{table}_{'_'.join(columns)}"
+        if len(name) > 60:
+            name = f"{AUTO_INDEX_PREFIX}{table[:20]}_{hashlib.sha256(name.encode('utf-8')).hexdigest()[:12]}"
+        return name
+
+    @staticmethod
+    def _existing_indexes(conn):
+        """{index name: (table, columns)} of every index in the db"""
+        indexes = {}
+        for name, table in conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type='index'"):
+            columns = tuple(row[2] for row in conn.execute(f'PRAGMA index_info("{name}")'))
+            indexes[name] = (table, columns)
+        return indexes
+
+    @staticmethod
+    def _table_columns(conn):
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%__staging'")]
+        return {table: [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')] for table in tables}
+
+    #------ sizes ------
+    @staticmethod
+    def _index_bytes(conn, name):
+        """On-disk size of an index, from dbstat when sqlite has it, else estimated from its rows and columns"""
+        try:
+            size = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name=?", (name,)).fetchone()[0]
+            return int(size or 0)
+        except sqlite3.Error:
+            pass
+        row = conn.execute("SELECT tbl_name FROM sqlite_master WHERE name=?", (name,)).fetchone()
+        if row is None:
+            return 0
+        columns = [r[2] for r in conn.execute(f'PRAGMA index_info("{name}")')]
+        return IndexAdvisor._estimate_bytes(conn, row[0], columns)
+
+    @staticmethod
+    def _estimate_bytes(conn, table, columns):
+        """Rough size of an index over `columns`: rows x (key bytes + rowid and cell overhead)"""
+        lengths = ', '.join(f'AVG(LENGTH("{column}"))' for column in columns)
+        row = conn.execute(f'SELECT COUNT(*), {lengths} FROM "{table}"').fetchone()
+        return int(row[0] * (sum(value or 0 for value in row[1:]) + 12))
+
+    #------ run ------
+    def _time_queries(self, conn, queries):
+        #under the guard's deadline when there is one, rows are read in batches and thrown away
+        timings = {}
+        for sql in queries:
+            start = time.perf_counter()
+            try:
+                with self.guard.limits(conn) if self.guard is not None else nullcontext():
+                    cursor = conn.execute(sql)
+                    while cursor.fetchmany(1000):
+                        pass
+                timings[sql] = round((time.perf_counter() - start) * 1000, 2)
+            except (sqlite3.Error, QueryRejected, QueryTimeout) as e:
+                timings[sql] = None
+                logger.info(f"Could not time query: {e}")
+        return timings
+
+    def run(self, tables=None, measure=True):
+        """
+        Creates/retires the auto indexes from the query log.
+
+        Args:
+            - tables: only consider these tables (e.g. the ones an ingest just rewrote), all when None
+            - measure: time the affected queries before and after (each runs twice, under the guard's deadline)
+
+        Returns:
+            - report: {"created", "dropped", "skipped_over_budget", "auto_index_bytes", "budget_bytes", "queries"}
+        """
+        with self._run_lock:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            try:
+                report = self._run(conn, tables, measure)
+            finally:
+                conn.close()
+            self.last_report = report
+            return report
+
+    def _run(self, conn, tables, measure):
+        table_columns = self._table_columns(conn)
+        existing = self._existing_indexes(conn)
+
+        #score the candidate indexes of every logged query that scans a table
+        scores = {}
+        affected = {}
+        wanted = set()
+        for sql, runs in self.logged_queries():
+            usage = query_column_usage(sql, table_columns)
+            if not usage:
+                continue
+            scanned = self.scanned_tables(conn, sql)
+            for candidate in self._candidates(usage, scanned):
+                if not candidate[1] or (tables is not None and candidate[0] not in tables):
+                    continue
+                wanted.add(candidate)
+                scores[candidate] = scores.get(candidate, 0) + runs
+                affected.setdefault(candidate, []).append((runs, sql))
+            #auto indexes a logged query is still using are kept too
+            for name in self.plan_indexes(conn, sql):
+                if name.startswith(AUTO_INDEX_PREFIX) and name in existing:
+                    wanted.add(existing[name])
+
+        #drop auto indexes nobody asks for any more
+        dropped = []
+        for name, (table, columns) in list(existing.items()):
+            if not name.startswith(AUTO_INDEX_PREFIX) or (tables is not None and table not in tables):
+                continue
+            if (table, columns) not in wanted:
+                conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+                del existing[name]
+                dropped.append(name)
+
+        def covered(table, columns):
+            #any index whose leading columns are these already serves the query
+            return any(t == table and existing_columns[:len(columns)] == columns
+                       for t, existing_columns in existing.values())
+
+        #a candidate that is the prefix of a longer one is served by it, fold it in
+        for table, columns in sorted(scores, key=lambda c: len(c[1])):
+            longer = [c for c in scores if c[0] == table and len(c[1]) > len(columns) and c[1][:len(columns)] == columns]
+            if longer:
+                target = max(longer, key=lambda c: scores[c])
+                del scores[(table, columns)]
+                for runs, sql in affected.pop((table, columns)):
+                    if (runs, sql) not in affected[target]:
+                        affected[target].append((runs, sql))
+                        scores[target] += runs
+
+        ranked = sorted((c for c in scores if not covered(*c)), key=lambda c: (-scores[c], c))
+        queries = []
+        for candidate in ranked:
+            queries.extend(sql for _, sql in sorted(affected[candidate], reverse=True))
+        queries = list(dict.fromkeys(queries))[:self.report_queries]
+        before = self._time_queries(conn, queries) if measure else {}
+
+        auto_bytes = sum(self._index_bytes(conn, name) for name in existing if name.startswith(AUTO_INDEX_PREFIX))
+        created, skipped = [], []
+        per_table = {}
+        for name, (table, _) in existing.items():
+            if name.startswith(AUTO_INDEX_PREFIX):
+                per_table[table] = per_table.get(table, 0) + 1
+        for table, columns in ranked:
+            if covered(table, columns) or per_table.get(table, 0) >= self.max_indexes_per_table:
+                continue
+            name = self._index_name(table, columns)
+            estimate = self._estimate_bytes(conn, table, columns)
+            if auto_bytes + estimate > self.disk_budget_bytes:
+                skipped.append({'index': name, 'estimated_bytes': estimate})
+                continue
+            column_sql = ', '.join(f'"{column}"' for column in columns)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_sql})')
+            size = self._index_bytes(conn, name)
+            if auto_bytes + size > self.disk_budget_bytes:
+                conn.execute(f'DROP INDEX "{name}"')
+                skipped.append({'index': name, 'estimated_bytes': size})
+                continue
+            auto_bytes += size
+            existing[name] = (table, columns)
+            per_table[table] = per_table.get(table, 0) + 1
+            created.append({'index': name, 'table': table, 'columns': list(columns), 'bytes': size,
+                            'query_runs': scores[(table, columns)]})
+        if created:
+            conn.execute("ANALYZE")
+        conn.commit()
+
+        after = self._time_queries(conn, queries) if measure else {}
+        report = {
+            'created': created,
+            'dropped': dropped,
+            'skipped_over_budget': skipped,
+            'auto_index_bytes': auto_bytes,
+            'budget_bytes': self.disk_budget_bytes,
+            'queries': [{'sql': sql, 'before_ms': before.get(sql), 'after_ms': after.get(sql)} for sql in queries],
+        }
+        logger.info(f"Index advisor created {len(created)}, dropped {len(dropped)} indexes")
+        return report
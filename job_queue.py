@@ -0,0 +1,178 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Persistent queue of ingest jobs processed by a local pool of worker threads.
+
+    Jobs live in a sqlite file, so queued jobs survive a restart (jobs that were running when the
+    process stopped are put back in the queue). A job is a set of tables to ingest, each with the
+    csv file name and its sha256. Uploading a table that is already waiting in a queued job merges
+    the new upload into that job instead of queueing the same work twice, and a job is never started
+    while another running job holds one of its tables.
+
+    `handler(job_id, tables, progress)` does the work. `progress(table, stage, status)` records
+    per-table progress and the handler's return value is stored as the job's report.
+    """
+    def __init__(self, handler, db_path='jobs.db', workers=1, poll_seconds=1.0):
+        self.handler = handler
+        self.db_path = db_path
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                tables TEXT NOT NULL,
+                progress TEXT NOT NULL DEFAULT '{}',
+                report TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at);
+        """)
+
+    #------ producer side ------
+    def enqueue(self, tables: dict) -> dict:
+        """
+        Queues `tables` ({table_name: {"filename", "sha256"}}).
+
+        Returns:
+            - {"job_id", "coalesced"}: coalesced is True when the tables were merged into a queued job
+        """
+        with self._lock:
+            for row in self.conn.execute("SELECT job_id, tables FROM jobs WHERE status='queued' ORDER BY created_at"):
+                queued_tables = json.loads(row['tables'])
+                if set(queued_tables) & set(tables):
+                    queued_tables.update(tables)
+                    self.conn.execute("UPDATE jobs SET tables=? WHERE job_id=?",
+                                      (json.dumps(queued_tables), row['job_id']))
+                    self.conn.commit()
+                    logger.info(f"Coalesced upload of {list(tables)} into job {row['job_id']}")
+                    return {'job_id': row['job_id'], 'coalesced': True}
+
+            job_id = uuid.uuid4().hex
+            self.conn.execute("INSERT INTO jobs (job_id, status, tables, created_at) VALUES (?, 'queued', ?, ?)",
+                              (job_id, json.dumps(tables), time.time()))
+            self.conn.commit()
+        self._wakeup.set()
+        return {'job_id': job_id, 'coalesced': False}
+
+    def pending_hash(self, table_name):
+        """sha256 the last pending (queued, else running) job for `table_name` will ingest it from, None when there is none"""
+        with self._lock:
+            #queued jobs only start once the running job on the same tables finished
+            rows = self.conn.execute("""SELECT tables FROM jobs WHERE status IN ('queued', 'running')
+                                        ORDER BY status = 'queued' DESC, created_at DESC""").fetchall()
+        for row in rows:
+            entry = json.loads(row['tables']).get(table_name)
+            if entry is not None:
+                return entry['sha256']
+        return None
+
+    def get(self, job_id: str):
+        """Job status dict, or None for an unknown id"""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['tables'] = json.loads(job['tables'])
+        job['progress'] = json.loads(job['progress'])
+        job['report'] = json.loads(job['report']) if job['report'] else None
+        if job['started_at']:
+            job['seconds'] = round((job['finished_at'] or time.time()) - job['started_at'], 3)
+        return job
+
+    #------ worker side ------
+    def _claim(self):
+        """Marks the oldest queued job whose tables aren't held by a running job as running"""
+        with self._lock:
+            busy = set()
+            for row in self.conn.execute("SELECT tables FROM jobs WHERE status='running'"):
+                busy.update(json.loads(row['tables']))
+            for row in self.conn.execute("SELECT job_id, tables FROM jobs WHERE status='queued' ORDER BY created_at"):
+                tables = json.loads(row['tables'])
+                if busy & set(tables):
+                    continue
+                self.conn.execute("UPDATE jobs SET status='running', started_at=?, progress='{}' WHERE job_id=?",
+                                  (time.time(), row['job_id']))
+                self.conn.commit()
+                return row['job_id'], tables
+        return None
+
+    def _set_progress(self, job_id, table_name, stage, status):
+        with self._lock:
+            row = self.conn.execute("SELECT progress FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+            progress = json.loads(row['progress'])
+            table_progress = progress.setdefault(table_name, {'stages': {}})
+            table_progress['stages'][stage] = status
+            table_progress['stage'] = stage
+            self.conn.execute("UPDATE jobs SET progress=? WHERE job_id=?", (json.dumps(progress), job_id))
+            self.conn.commit()
+
+    def _finish(self, job_id, status, report=None, error=None):
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET status=?, report=?, error=?, finished_at=? WHERE job_id=?",
+                              (status, json.dumps(report, default=str) if report is not None else None,
+                               error, time.time(), job_id))
+            self.conn.commit()
+        #a finished job may unblock queued jobs on the same tables
+        self._wakeup.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            claimed = self._claim()
+            if claimed is None:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
+                continue
+            job_id, tables = claimed
+            logger.info(f"Running job {job_id} for {list(tables)}")
+            try:
+                report = self.handler(job_id, tables,
+                                      lambda table, stage, status: self._set_progress(job_id, table, stage, status))
+                failed = any(step['status'] == 'failed' for steps in (report or {}).values() for step in steps)
+                self._finish(job_id, 'failed' if failed else 'succeeded', report=report,
+                             error='one or more stages failed' if failed else None)
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                self._finish(job_id, 'failed', error=f"{e}\n{traceback.format_exc()}")
+
+    def start(self):
+        """Requeues jobs interrupted by a restart and starts the worker threads"""
+        with self._lock:
+            #the pipeline skips whatever those jobs had already completed
+            self.conn.execute("UPDATE jobs SET status='queued', started_at=NULL WHERE status='running'")
+            self.conn.commit()
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'ingest-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        """Stops the workers after their current job"""
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
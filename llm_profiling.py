@@ -1,3 +1,4 @@
+import hashlib
 import json
 import pandas as pd
 import sqlite3
@@ -5,9 +6,152 @@ import google.generativeai as genai
 import json
 import os
 import re
+import random
+import threading
+import time
 from dotenv import load_dotenv
 from db_profiling import DatabaseProfiler
 import json
+
+#http status codes worth retrying: quota/rate limit, server errors and timeouts
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate_per_minute` tokens are added per minute up to `burst`,
+    and every llm request takes one. Set the rate to the gemini requests-per-minute quota.
+    """
+    def __init__(self, rate_per_minute=60, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1, rate_per_minute // 10))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient_error(error) -> bool:
+    """True for errors a retry can fix (rate limits, 5xx, timeouts, dropped connections)"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    #google.api_core exceptions carry the http status in `code`
+    code = getattr(error, 'code', None)
+    try:
+        return int(code) in TRANSIENT_STATUS_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_llm_json(text):
+    """
+    Parses a json llm response, tolerating markdown fences and text around the object.
+
+    Raises:
+        - ValueError when no json object can be parsed
+    """
+    cleaned = text.strip().replace('```json', '').replace('```', '').strip()
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError:
+        json_match = re.search(r'\{.*\}', cleaned, re.DOTALL)
+        if json_match:
+            try:
+                return json.loads(json_match.group())
+            except json.JSONDecodeError:
+                pass
+    raise ValueError(f"LLM response is not valid JSON: {cleaned[:200]!r}")
+
+
+class RateLimitedLLM:
+    """
+    Wraps an llm client so every call goes through a shared token bucket and transient failures
+    are retried with full-jitter exponential backoff. Safe to call from several threads at once,
+    at most `max_concurrent` calls are in flight across all of them (unbounded when None).
+    """
+    def __init__(self, llm_client, requests_per_minute=60, burst=None, max_retries=4,
+                 base_delay=1.0, max_delay=30.0, json_retries=1, max_concurrent=None):
+        self.llm_client = llm_client
+        self.bucket = TokenBucket(requests_per_minute, burst)
+        self._in_flight = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.json_retries = json_retries
+
+    def _backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def generate_text(self, prompt):
+        """Response text for `prompt`, retrying transient errors"""
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                #the slot is only held for the call itself, not while backing off
+                if self._in_flight is None:
+                    return self.llm_client.generate_content(prompt).text
+                with self._in_flight:
+                    return self.llm_client.generate_content(prompt).text
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                print(f"LLM call failed ({e}), retry {attempt + 1} of {self.max_retries}")
+                self._backoff(attempt)
+
+    def generate_json(self, prompt):
+        """Parsed json response for `prompt`, an unparseable response is asked for again `json_retries` times"""
+        for attempt in range(self.json_retries + 1):
+            text = self.generate_text(prompt)
+            try:
+                return parse_llm_json(text)
+            except ValueError:
+                if attempt == self.json_retries:
+                    raise
+                print("LLM returned invalid JSON, asking again")
+
+
+def _significant(value, digits=2):
+    """Rounds a number to `digits` significant digits"""
+    if value is None:
+        return None
+    return float(f"{float(value):.{digits}g}")
+
+
+def column_profile_fingerprint(col_data, row_count) -> str:
+    """
+    Hash of the parts of a column's statistical profile that shape its description.
+
+    The numbers are quantized (2 significant digits, null share in 5% steps, only patterns covering
+    at least 10% of the values) so a re-upload with a few more rows keeps the same fingerprint and
+    only a material change in the statistics asks the llm to describe the column again.
+    """
+    non_null = max(1, row_count - col_data.get('null_count', 0))
+    patterns = col_data.get('common_patterns') or {}
+    key = {
+        'data_type': col_data.get('data_type'),
+        'distinct_count': _significant(col_data.get('distinct_count')),
+        'null_share': round(col_data.get('null_count', 0) / max(1, row_count) * 20) / 20,
+        'min_value': _significant(col_data.get('min_value')),
+        'max_value': _significant(col_data.get('max_value')),
+        'min_length': col_data.get('min_length'),
+        'max_length': _significant(col_data.get('max_length')),
+        'patterns': sorted(name for name, count in patterns.items() if count / non_null >= 0.1),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
 class LLMProfilingSummarizer:
     def __init__(self, llm_client):
         """
@@ -16,9 +160,34 @@ class LLMProfilingSummarizer:
         self.llm_client = llm_client
 
 
+    @staticmethod
+    def column_section(col_name, col_data, row_count):
+        """Profiling text of one column in the prompt"""
+        section = f"\n--- Column: {col_name} ---\n"
+        section += f"Data Type: {col_data['data_type']}\n"
+        section += f"Null Values: {col_data['null_count']} out of {row_count}\n"
+        if 'distinct_count_bounds' in col_data:
+            low, high = col_data['distinct_count_bounds']
+            section += f"Distinct Values: about {col_data['distinct_count']} ({low} to {high})\n"
+        else:
+            section += f"Distinct Values: {col_data['distinct_count']}\n"
+        
+        if col_data['min_value'] is not None:
+            section += f"Value Range: {col_data['min_value']} to {col_data['max_value']}\n"
+        
+        if 'min_length' in col_data and col_data['min_length'] is not None:
+            section += f"Length Range: {col_data['min_length']} to {col_data['max_length']} characters\n"
+        
+        # if col_data['sample_values']:
+        #     section += f"Sample Values: {col_data['sample_values'][:5]}\n"  # First 5 samples
+        
+        if 'common_patterns' in col_data and col_data['common_patterns']:
+            section += f"Patterns: {col_data['common_patterns']}\n"
+        return section
+
     #next func
-    def create_profile_prompt(self, table_name, profile_data):
-        """Create a comprehensive prompt for all columns in a table"""
+    def create_profile_prompt(self, table_name, profile_data, columns=None):
+        """Create a comprehensive prompt for the columns of a table (all of them unless `columns` is given)"""
         
         prompt = f"""You are a database expert analyzing the table '{table_name}' with {profile_data['row_count']} rows.
 
@@ -31,23 +200,10 @@ Format your response as a JSON object where keys are column names and values hav
 Here is the profiling data:
 
 """
-        for col_name, col_data in profile_data['columns'].items():
-            prompt += f"\n--- Column: {col_name} ---\n"
-            prompt += f"Data Type: {col_data['data_type']}\n"
-            prompt += f"Null Values: {col_data['null_count']} out of {profile_data['row_count']}\n"
-            prompt += f"Distinct Values: {col_data['distinct_count']}\n"
-            
-            if col_data['min_value'] is not None:
-                prompt += f"Value Range: {col_data['min_value']} to {col_data['max_value']}\n"
-            
-            if 'min_length' in col_data and col_data['min_length'] is not None:
-                prompt += f"Length Range: {col_data['min_length']} to {col_data['max_length']} characters\n"
-            
-            # if col_data['sample_values']:
-            #     prompt += f"Sample Values: {col_data['sample_values'][:5]}\n"  # First 5 samples
-            
-            if 'common_patterns' in col_data and col_data['common_patterns']:
-                prompt += f"Patterns: {col_data['common_patterns']}\n"
+        if columns is None:
+            columns = list(profile_data['columns'])
+        for col_name in columns:
+            prompt += self.column_section(col_name, profile_data['columns'][col_name], profile_data['row_count'])
         
         prompt += """
 
@@ -67,6 +223,28 @@ example response:
 
 """
         return prompt
+
+    def batch_columns(self, profile_data, columns=None, max_columns=25, max_chars=6000):
+        """
+        Splits columns into batches of at most `max_columns` columns and about `max_chars` of profiling
+        text, so wide tables are described in several small requests instead of one long, truncation prone one.
+
+        Returns:
+            - list of column name lists
+        """
+        if columns is None:
+            columns = list(profile_data['columns'])
+        batches, batch, batch_chars = [], [], 0
+        for col_name in columns:
+            chars = len(self.column_section(col_name, profile_data['columns'][col_name], profile_data['row_count']))
+            if batch and (len(batch) >= max_columns or batch_chars + chars > max_chars):
+                batches.append(batch)
+                batch, batch_chars = [], 0
+            batch.append(col_name)
+            batch_chars += chars
+        if batch:
+            batches.append(batch)
+        return batches
     
     def summarize_table_profile(self, table_name, profile_data):
         """Get LLM summaries for all columns in a table in one call"""
@@ -0,0 +1,313 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from db_setup import DatabaseSetup
+from db_profiling import DatabaseProfiler, profiling_process_pool
+from llm_profiling import LLMProfilingSummarizer, RateLimitedLLM, column_profile_fingerprint
+
+
+def fingerprint(value) -> str:
+    """Stable short hash of any json-serializable value"""
+    if not isinstance(value, (str, bytes)):
+        value = json.dumps(value, sort_keys=True, default=str)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return hashlib.sha256(value).hexdigest()[:16]
+
+
+def file_sha256(file_path, chunk_bytes=1024 * 1024) -> str:
+    """sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_bytes):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProfilingPipeline:
+    """
+    The update_db pipeline as a small DAG of per-table stages:
+
+        ingest -> stats -> llm -> merge
+
+    Stage outputs live in the catalog (see catalog.py), recorded with the fingerprint of their inputs:
+        - ingest: sha256 of the csv
+        - stats: the ingest fingerprint (the data version)
+        - llm: the fingerprints of the columns' quantized statistics
+        - merge: the stats and llm output fingerprints
+    A stage whose input fingerprint matches the recorded one is skipped and its stored output reused,
+    so re-profiling a table whose stats didn't change reuses the llm descriptions without a gemini call.
+
+    The llm stage runs for up to `llm_concurrency` tables at once, all sharing one rate limiter set to
+    `llm_requests_per_minute`. A table whose llm call fails only fails that table. Within a table the
+    columns are described in batches of `llm_batch_columns`, and each column's description is cached
+    by its statistics so unchanged columns are never sent again. With `profile_workers` > 1 the stats
+    stage profiles tables and column groups in that many worker processes.
+    """
+    STAGES = ('ingest', 'stats', 'llm', 'merge')
+
+    def __init__(self, model, catalog, db_path='cloud_costs.db',
+                 result_cache=None, chunk_rows=None, llm_concurrency=4, llm_requests_per_minute=60,
+                 llm_batch_columns=25, approx_threshold_rows=None, profile_modes=None, profile_workers=1):
+        self.model = model
+        self.catalog = catalog
+        self.db_path = db_path
+        self.result_cache = result_cache
+        self.chunk_rows = chunk_rows
+        self.llm_profiler = LLMProfilingSummarizer(llm_client=model)
+        #tables and their description batches both run in parallel, the llm caps the calls in flight across all of them
+        self.llm = RateLimitedLLM(model, requests_per_minute=llm_requests_per_minute,
+                                  max_concurrent=max(1, llm_concurrency))
+        self.llm_concurrency = llm_concurrency
+        self.llm_batch_columns = llm_batch_columns
+        self.approx_threshold_rows = approx_threshold_rows
+        self.profile_modes = profile_modes or {}
+        self.profile_workers = profile_workers
+
+    #------ state ------
+    def _record(self, table_name, stage, input_fp, output_fp):
+        self.catalog.record_stage(table_name, stage, input_fp, output_fp)
+
+    def _recorded(self, table_name, stage):
+        return self.catalog.table_state(table_name).get(stage)
+
+    def ingested_hash(self, table_name):
+        """sha256 of the csv the table was last ingested from, or None"""
+        entry = self._recorded(table_name, 'ingest')
+        return entry['input'] if entry else None
+
+    def is_current(self, table_name, sha256) -> bool:
+        """True when the table was ingested from these exact bytes and every later stage completed"""
+        state = self.catalog.table_state(table_name)
+        if state.get('ingest', {}).get('input') != sha256:
+            return False
+        return all(stage in state for stage in self.STAGES)
+
+    def _table_exists(self, table_name):
+        if not os.path.exists(self.db_path):
+            return False
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                                (table_name,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    #------ run ------
+    def run(self, required_map, file_hashes=None, progress=None):
+        """
+        Runs the pipeline for the given tables.
+
+        Args:
+            - required_map: {table_name: Path to csv}
+            - file_hashes: optional {table_name: sha256} (computed from the file when missing)
+            - progress: optional callback(table_name, stage, status)
+
+        Returns:
+            - {table_name: [{"stage", "status": ran|skipped|failed, "seconds", ("error")}]}
+        """
+        file_hashes = dict(file_hashes or {})
+        report = {table_name: [] for table_name in required_map}
+        failed = set()
+
+        def step(table_name, stage, func):
+            if table_name in failed:
+                return None
+            if progress:
+                progress(table_name, stage, 'running')
+            start = time.perf_counter()
+            try:
+                status, output = func()
+            except Exception as e:
+                failed.add(table_name)
+                report[table_name].append({'stage': stage, 'status': 'failed',
+                                           'seconds': round(time.perf_counter() - start, 3), 'error': str(e)})
+                print(f"{stage} failed for {table_name}: {e}")
+                if progress:
+                    progress(table_name, stage, 'failed')
+                return None
+            report[table_name].append({'stage': stage, 'status': status,
+                                       'seconds': round(time.perf_counter() - start, 3)})
+            if progress:
+                progress(table_name, stage, status)
+            return output
+
+        #ingest
+        setup = DatabaseSetup(required_map, db_path=self.db_path, result_cache=self.result_cache,
+                              chunk_rows=self.chunk_rows)
+        if not setup.create_connection():
+            raise RuntimeError(f"Could not open {self.db_path}")
+        data_versions = {}
+        for table_name, file_path in required_map.items():
+            if table_name not in file_hashes:
+                file_hashes[table_name] = file_sha256(file_path)
+            data_versions[table_name] = step(table_name, 'ingest',
+                                             lambda: self._ingest(setup, table_name, file_path, file_hashes[table_name]))
+        if setup.loaded_tables:
+            setup.verify_database()
+            self._save_summary(setup.get_database_summary())
+        setup.conn.close()
+
+        #stats, the tables and column groups of wide tables spread over a process pool
+        stale = [table_name for table_name in required_map
+                 if table_name not in failed and not self._stats_current(table_name, data_versions[table_name])]
+        executor = profiling_process_pool(self.profile_workers) if self.profile_workers > 1 and stale else None
+        profiler = DatabaseProfiler(table_map=list(required_map.keys()), db_path=self.db_path,
+                                    approx_threshold_rows=self.approx_threshold_rows, table_modes=self.profile_modes,
+                                    executor=executor)
+        try:
+            with ThreadPoolExecutor(max_workers=len(required_map) if executor else 1,
+                                    thread_name_prefix='stats') as threads:
+                futures = {
+                    table_name: threads.submit(step, table_name, 'stats',
+                                               lambda table_name=table_name: self._stats(profiler, table_name,
+                                                                                         data_versions[table_name]))
+                    for table_name in required_map
+                }
+                stats = {table_name: future.result() for table_name, future in futures.items()}
+        finally:
+            profiler.conn.close()
+            if executor is not None:
+                executor.shutdown()
+
+        #llm descriptions, several tables at once
+        with ThreadPoolExecutor(max_workers=max(1, self.llm_concurrency), thread_name_prefix='llm') as executor:
+            futures = {
+                table_name: executor.submit(step, table_name, 'llm',
+                                            lambda table_name=table_name: self._llm(table_name, stats[table_name]))
+                for table_name in required_map
+            }
+            descriptions = {table_name: future.result() for table_name, future in futures.items()}
+
+        #merged profile
+        for table_name in required_map:
+            step(table_name, 'merge', lambda: self._merge(table_name, stats[table_name], descriptions[table_name]))
+        return report
+
+    @staticmethod
+    def stages_ran(report, stage):
+        """Tables for which `stage` actually ran in a report"""
+        return [table for table, steps in report.items()
+                if any(s['stage'] == stage and s['status'] == 'ran' for s in steps)]
+
+    #------ stages ------
+    def _ingest(self, setup, table_name, file_path, sha256):
+        recorded = self._recorded(table_name, 'ingest')
+        if recorded and recorded['input'] == sha256 and self._table_exists(table_name):
+            return 'skipped', recorded['output']
+        if not setup.load_table(table_name, Path(file_path)):
+            raise RuntimeError(f"loading {file_path} failed")
+        self._record(table_name, 'ingest', sha256, sha256)
+        return 'ran', sha256
+
+    def _stats_current(self, table_name, data_version):
+        recorded = self._recorded(table_name, 'stats')
+        return bool(recorded and recorded['input'] == data_version
+                    and self.catalog.get_stats(table_name) is not None)
+
+    def _stats(self, profiler, table_name, data_version):
+        if self._stats_current(table_name, data_version):
+            return 'skipped', self.catalog.get_stats(table_name)
+        profile = profiler.profile_table(table_name=table_name)
+        self.catalog.put_stats(table_name, profile)
+        self._record(table_name, 'stats', data_version, fingerprint(profile))
+        return 'ran', profile
+
+    def _llm(self, table_name, profile):
+        #the stage input is the per-column profile fingerprints: only columns whose statistics
+        #materially changed are described again
+        column_fps = {col_name: column_profile_fingerprint(col_data, profile['row_count'])
+                      for col_name, col_data in profile['columns'].items()}
+        llm_fp = fingerprint([table_name, column_fps])
+        recorded = self._recorded(table_name, 'llm')
+        if recorded and recorded['input'] == llm_fp:
+            return 'skipped', self.catalog.get_llm(table_name)
+
+        descriptions = {}
+        missing = []
+        for col_name in profile['columns']:
+            cached = self.catalog.cached_description(table_name, col_name, column_fps[col_name])
+            if cached is not None:
+                descriptions[col_name] = cached
+            else:
+                missing.append(col_name)
+
+        #the remaining columns go out in size-bounded batches, in parallel
+        batches = self.llm_profiler.batch_columns(profile, missing, max_columns=self.llm_batch_columns)
+        if batches:
+            print(f"Describing {len(missing)} of {len(column_fps)} columns of {table_name} in {len(batches)} batches")
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, self.llm_concurrency), thread_name_prefix='llm-batch') as executor:
+            futures = [executor.submit(self._describe_batch, table_name, profile, batch) for batch in batches]
+            for future in futures:
+                try:
+                    described = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                descriptions.update(described)
+                #cached straight away, so a retry after a failed batch only re-sends the failed columns
+                self.catalog.cache_descriptions(table_name, described, column_fps)
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(batches)} description batches failed: {errors[0]}")
+        #the stage is only recorded once every column has a description, otherwise the next run retries the rest
+        undescribed = [col_name for col_name in profile['columns'] if col_name not in descriptions]
+        if undescribed:
+            raise RuntimeError(f"no description for {len(undescribed)} columns of {table_name}: {undescribed[:5]}")
+
+        parsed_json = {col_name: descriptions[col_name] for col_name in profile['columns'] if col_name in descriptions}
+        self.catalog.put_llm(table_name, parsed_json)
+        self._record(table_name, 'llm', llm_fp, fingerprint(parsed_json))
+        return 'ran', parsed_json
+
+    def _describe_batch(self, table_name, profile, columns, rerequests=1):
+        """
+        Descriptions of one batch of columns, only the columns asked for are kept.
+        Columns the response skipped are asked for again (`rerequests` times), a batch that
+        still lacks some columns returns the ones it got and `_llm` fails the stage.
+        """
+        described = {}
+        pending = list(columns)
+        for _ in range(rerequests + 1):
+            prompt = self.llm_profiler.create_profile_prompt(table_name=table_name, profile_data=profile, columns=pending)
+            #rate limited, transient errors and invalid json are retried
+            response = self.llm.generate_json(prompt)
+            for col_name in pending:
+                entry = response.get(col_name)
+                if isinstance(entry, dict) and 'short_description' in entry and 'long_description' in entry:
+                    described[col_name] = {'short_description': entry['short_description'],
+                                           'long_description': entry['long_description']}
+            pending = [col_name for col_name in pending if col_name not in described]
+            if not pending:
+                break
+        if not described:
+            raise ValueError(f"no column descriptions in the response for {columns[0]}..{columns[-1]}")
+        return described
+
+    def _merge(self, table_name, profile, llm_profile):
+        state = self.catalog.table_state(table_name)
+        merge_fp = fingerprint([state['stats']['output'], state['llm']['output']])
+        if state.get('merge', {}).get('input') == merge_fp:
+            published = self.catalog.get_published(table_name)
+            if published is not None:
+                return 'skipped', published
+
+        merged = copy.deepcopy(profile)
+        for col_name, col_data in merged['columns'].items():
+            col_data.setdefault('short_description', '')
+            col_data.setdefault('long_description', '')
+            col_data.update(llm_profile.get(col_name, {}))
+        #only this table's rows change, publishing bumps the schema version
+        self.catalog.publish(table_name, merged)
+        self._record(table_name, 'merge', merge_fp, fingerprint(merged))
+        return 'ran', merged
+
+    def _save_summary(self, summary):
+        """Stores the ingest summary of the tables this run ingested"""
+        self.catalog.put_summaries(summary['tables'])
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#words that don't change which sql a question maps to
+STOP_WORDS = {
+    'a', 'an', 'the', 'please', 'show', 'give', 'tell', 'list', 'find', 'get',
+    'me', 'us', 'i', 'we', 'you', 'my', 'our', 'can', 'could', 'would', 'will',
+    'what', 'which', 'whats', 'is', 'are', 'was', 'were', 'be', 'do', 'does',
+    'of', 'for', 'to', 'in', 'on', 'at', 'all', 'want', 'like', 'know',
+}
+
+#a minus sign only counts when it starts the number, not in "2023-24"
+_QUESTION_TOKEN = re.compile(r'(?<![\w.])-\d+(?:\.\d+)?|\d+(?:\.\d+)?|\w+|<=|>=|!=|<>|=|<|>|%')
+
+
+def normalize_query(user_query: str) -> str:
+    """
+    Normalizes a natural language question for cache lookups.
+
+    Lowercases, drops apostrophes and sentence punctuation, collapses whitespace and removes stop words,
+    so "Show me the total compute cost for Azure, grouped by service." and
+    "total compute cost azure grouped by service" share one entry. Comparison operators, signed and
+    decimal numbers and % are kept, so "cost > 100" and "cost < 100" (or -5 and 5) stay apart.
+    """
+    text = user_query.lower().replace("'", '').replace('’', '')
+    words = [word for word in _QUESTION_TOKEN.findall(text) if word not in STOP_WORDS]
+    return ' '.join(words)
+
+
+class NLToSQLCache:
+    """
+    Persistent cache from (normalized question, schema version) to generated sql.
+
+    Entries live in a small sqlite file so they survive restarts. The cache is bounded by
+    `max_entries` (least recently used entries are evicted) and entries expire after
+    `ttl_seconds`. Each entry records the tables its sql reads, so `invalidate_tables()`
+    drops exactly the entries an ingest made stale.
+    """
+    def __init__(self, db_path='query_cache.db', max_entries=1000, ttl_seconds=7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sql_cache (
+                cache_key TEXT PRIMARY KEY,
+                normalized_query TEXT NOT NULL,
+                schema_version TEXT NOT NULL,
+                sql_query TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sql_cache_last_used ON sql_cache(last_used);
+            CREATE TABLE IF NOT EXISTS sql_cache_tables (
+                cache_key TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                PRIMARY KEY (cache_key, table_name)
+            );
+            CREATE INDEX IF NOT EXISTS sql_cache_tables_table ON sql_cache_tables(table_name);
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(user_query: str, schema_version: str) -> str:
+        """Hash of the normalized question and the schema version"""
+        raw = f"{normalize_query(user_query)}\x00{schema_version}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _delete(self, keys):
+        self.conn.executemany("DELETE FROM sql_cache WHERE cache_key=?", [(k,) for k in keys])
+        self.conn.executemany("DELETE FROM sql_cache_tables WHERE cache_key=?", [(k,) for k in keys])
+
+    def get(self, user_query: str, schema_version: str):
+        """Returns the cached sql for the question, or None on a miss (or an expired entry)"""
+        key = self.make_key(user_query, schema_version)
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT sql_query, created_at FROM sql_cache WHERE cache_key=?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            sql_query, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._delete([key])
+                self.conn.commit()
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE sql_cache SET last_used=? WHERE cache_key=?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return sql_query
+
+    def put(self, user_query: str, schema_version: str, sql_query: str, tables):
+        """Stores the sql for the question along with the tables it reads, evicting LRU entries over the limit"""
+        key = self.make_key(user_query, schema_version)
+        now = time.time()
+        with self._lock:
+            self._delete([key])
+            self.conn.execute(
+                "INSERT INTO sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, normalize_query(user_query), schema_version, sql_query, now, now),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO sql_cache_tables VALUES (?, ?)", [(key, table) for table in tables]
+            )
+            #expired entries go first, then the least recently used ones over the limit
+            expired = [r[0] for r in self.conn.execute(
+                "SELECT cache_key FROM sql_cache WHERE created_at < ?", (now - self.ttl_seconds,))]
+            over = [r[0] for r in self.conn.execute(
+                "SELECT cache_key FROM sql_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?", (self.max_entries,))]
+            stale = set(expired) | set(over)
+            if stale:
+                self._delete(stale)
+                self.evictions += len(stale)
+            self.conn.commit()
+
+    def discard(self, user_query: str, schema_version: str):
+        """Removes one entry (e.g. when its sql failed to run)"""
+        with self._lock:
+            self._delete([self.make_key(user_query, schema_version)])
+            self.conn.commit()
+
+    def invalidate_tables(self, tables) -> int:
+        """Drops every entry whose sql reads one of `tables`, returns how many were dropped"""
+        tables = list(tables)
+        if not tables:
+            return 0
+        placeholders = ','.join('?' * len(tables))
+        with self._lock:
+            keys = [r[0] for r in self.conn.execute(
+                f"SELECT DISTINCT cache_key FROM sql_cache_tables WHERE table_name IN ({placeholders})", tables)]
+            self._delete(keys)
+            self.conn.commit()
+            self.invalidations += len(keys)
+        if keys:
+            logger.info(f"Invalidated {len(keys)} cached queries for tables {tables}")
+        return len(keys)
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM sql_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'entries': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
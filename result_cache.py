@@ -0,0 +1,120 @@
+import logging
+import re
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+#double-quoted tokens are kept as written: sqlite reads "AWS" as a string literal when no column has that name
+_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(--[^\n]*|/\*.*?\*/)|(\s+)|([^'"\s/-]+|[-/"])""", re.DOTALL)
+
+
+def canonicalize_sql(sql: str) -> str:
+    """
+    Canonical form of a sql statement for cache keys.
+
+    Comments are removed, whitespace is collapsed, everything outside string literals and
+    double-quoted tokens is lowercased (sqlite keywords and bare identifiers are case-insensitive)
+    and a trailing `;` is dropped.
+    """
+    parts = []
+    for literal, comment, space, other in _TOKENS.findall(sql):
+        if literal:
+            parts.append(literal)
+        elif comment or space:
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        else:
+            parts.append(other.lower())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def estimate_records_bytes(records) -> int:
+    """Approximate in-memory size of a list of row dicts"""
+    size = sys.getsizeof(records)
+    for row in records:
+        size += sys.getsizeof(row)
+        for value in row.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+class ResultCache:
+    """
+    In-memory cache of sql results, keyed by the canonical sql and the data version of every table it reads.
+
+    Each table has a version counter that `invalidate_table()` bumps whenever the table is rewritten, so
+    results computed against older data can never be served again. Entries are evicted least recently used
+    first once the cached results exceed `max_bytes`.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() #key -> (records, size, tables)
+        self._table_versions = defaultdict(int)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, sql: str, tables):
+        """Cache key for `sql` at the current data version of `tables`"""
+        with self._lock:
+            versions = tuple((table.lower(), self._table_versions[table.lower()]) for table in sorted(tables))
+        return (canonicalize_sql(sql), versions)
+
+    def get(self, key):
+        """Returns the cached records for `key`, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, records, size_bytes=None):
+        """Caches `records`, evicting least recently used results until the memory budget fits"""
+        size_bytes = estimate_records_bytes(records) if size_bytes is None else size_bytes
+        if size_bytes > self.max_bytes:
+            return
+        tables = {table for table, _ in key[1]}
+        with self._lock:
+            #the data changed while the query ran, the result is already stale
+            if any(self._table_versions[table] != version for table, version in key[1]):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (records, size_bytes, tables)
+            self.current_bytes += size_bytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate_table(self, table_name: str):
+        """Bumps the data version of a rewritten table and frees the results that read it"""
+        table = table_name.lower()
+        with self._lock:
+            self._table_versions[table] += 1
+            stale = [key for key, entry in self._entries.items() if table in entry[2]]
+            for key in stale:
+                self.current_bytes -= self._entries.pop(key)[1]
+        if stale:
+            logger.info(f"Dropped {len(stale)} cached results for {table_name}")
+
+    def stats(self) -> dict:
+        """Hit/miss counters and memory use"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,204 @@
+import json
+import random
+from collections import Counter, defaultdict
+
+import pandas as pd
+
+
+class ResultSummarizer:
+    """
+    Bounds the size of the sql results handed to the answer prompt.
+
+    Rows are added in chunks. While their text stays within `budget_bytes` they are passed through
+    unchanged. Past the budget the raw rows are dropped and the summarizer falls back to column-level
+    aggregates over every row seen (count, nulls, sum/min/max for numbers, top-k values for text with
+    the row count and first numeric column's sum per value) plus a uniform sample of rows, shrunk
+    by `finish` until its prompt text fits in the budget too.
+    Memory stays bounded by the budget, the sample and `max_groups` tracked values per column.
+    """
+    def __init__(self, budget_bytes=16000, sample_rows=20, top_k=10, max_groups=1000, seed=0):
+        self.budget_bytes = budget_bytes
+        self.sample_rows = sample_rows
+        self.top_k = top_k
+        self.max_groups = max_groups
+        self._random = random.Random(seed)
+
+        self.row_count = 0
+        self.columns = []
+        self._raw_rows = []
+        self._raw_bytes = 0
+        self.compacted = False
+        self._sample = []
+
+        self._numeric = {} #column -> {count, nulls, sum, min, max}
+        self._text = {} #column -> {count, nulls, counts: Counter, sums: defaultdict, truncated}
+        self._group_measure = None #first numeric column, summed per text value
+
+    def add_rows(self, rows):
+        """Adds a chunk of result rows (dicts)"""
+        if not rows:
+            return
+        if not self.columns:
+            self.columns = list(rows[0].keys())
+        start = self.row_count
+        self.row_count += len(rows)
+
+        if not self.compacted:
+            self._raw_rows.extend(rows)
+            self._raw_bytes += len(repr(rows))
+            if self._raw_bytes > self.budget_bytes:
+                self.compacted = True
+                #aggregates are built over everything seen so far, then the raw rows are released
+                self._aggregate(self._raw_rows)
+                self._sample_rows(self._raw_rows, 0)
+                self._raw_rows = []
+            return
+
+        self._aggregate(rows)
+        self._sample_rows(rows, start)
+
+    def _sample_rows(self, rows, start):
+        """Reservoir sampling (algorithm R) over the row stream"""
+        for offset, row in enumerate(rows):
+            seen = start + offset
+            if len(self._sample) < self.sample_rows:
+                self._sample.append(row)
+            else:
+                slot = self._random.randint(0, seen)
+                if slot < self.sample_rows:
+                    self._sample[slot] = row
+
+    def _aggregate(self, rows):
+        df = pd.DataFrame.from_records(rows, columns=self.columns)
+        #column kinds are fixed by the first chunk that gets aggregated
+        for column in self.columns:
+            if column in self._numeric or column in self._text:
+                continue
+            if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column]):
+                self._numeric[column] = {'count': 0, 'nulls': 0, 'sum': 0.0, 'min': None, 'max': None}
+                if self._group_measure is None:
+                    self._group_measure = column
+            else:
+                self._text[column] = {'count': 0, 'nulls': 0, 'counts': Counter(),
+                                      'sums': defaultdict(float), 'truncated': False}
+
+        measure = None
+        if self._group_measure is not None:
+            measure = pd.to_numeric(df[self._group_measure], errors='coerce')
+        for column in self.columns:
+            values = df[column]
+            non_null = values.dropna()
+            if column in self._numeric:
+                stats = self._numeric[column]
+                numbers = pd.to_numeric(non_null, errors='coerce').dropna()
+                stats['count'] += int(len(non_null))
+                stats['nulls'] += int(len(values) - len(non_null))
+                if len(numbers):
+                    stats['sum'] += float(numbers.sum())
+                    low, high = float(numbers.min()), float(numbers.max())
+                    stats['min'] = low if stats['min'] is None else min(stats['min'], low)
+                    stats['max'] = high if stats['max'] is None else max(stats['max'], high)
+            else:
+                stats = self._text[column]
+                stats['count'] += int(len(non_null))
+                stats['nulls'] += int(len(values) - len(non_null))
+                keys = non_null.astype(str)
+                chunk_counts = keys.value_counts()
+                if measure is not None:
+                    chunk_sums = measure.loc[keys.index].groupby(keys).sum()
+                for key, count in chunk_counts.items():
+                    if key not in stats['counts'] and len(stats['counts']) >= self.max_groups:
+                        stats['truncated'] = True
+                        continue
+                    stats['counts'][key] += int(count)
+                    if measure is not None:
+                        stats['sums'][key] += float(chunk_sums.get(key, 0.0))
+
+    def finish(self):
+        """
+        The summary is shrunk until its prompt text fits in `budget_bytes`: fewer sample rows,
+        shorter cell values and fewer top values first, then only the leading columns (a budget
+        too small for any column gets the row count alone).
+
+        Returns:
+            - (payload for the prompt, whether it was compacted)
+        """
+        if not self.compacted:
+            return self._raw_rows, False
+
+        #(sample rows, characters per text value, top values per column), least to most aggressive
+        levels = [(self.sample_rows, None, self.top_k), (self.sample_rows, 200, self.top_k), (10, 200, self.top_k),
+                  (10, 80, 5), (5, 80, 5), (5, 30, 3), (2, 30, 3), (0, 30, 1), (0, 30, 0)]
+        for sample_rows, value_chars, top_k in levels:
+            payload = self._summary(min(sample_rows, self.sample_rows), value_chars, min(top_k, self.top_k))
+            if self._fits(payload):
+                return payload, True
+        max_columns = len(self.columns) // 2
+        while max_columns > 0:
+            payload = self._summary(0, 30, 0, max_columns)
+            if self._fits(payload):
+                return payload, True
+            max_columns //= 2
+        return {'row_count': self.row_count, 'columns': {}, 'sample_rows': [],
+                'columns_omitted': len(self.columns)}, True
+
+    def _fits(self, payload):
+        return len(format_results_for_prompt(payload, True).encode('utf-8')) <= self.budget_bytes
+
+    @staticmethod
+    def _clip(value, value_chars):
+        if value_chars is not None and isinstance(value, str) and len(value) > value_chars:
+            return value[:value_chars] + '...'
+        return value
+
+    def _summary(self, sample_rows, value_chars, top_k, max_columns=None):
+        """The summary with at most these many sample rows, characters per text value, top values and columns"""
+        kept = self.columns if max_columns is None else self.columns[:max_columns]
+        columns = {}
+        for column in kept:
+            if column in self._numeric:
+                stats = self._numeric[column]
+                columns[column] = {key: stats[key] for key in ('count', 'nulls', 'sum', 'min', 'max')}
+            else:
+                stats = self._text[column]
+                top = []
+                for value, count in stats['counts'].most_common(top_k) if top_k else []:
+                    group = {'value': self._clip(value, value_chars), 'rows': count}
+                    if self._group_measure is not None:
+                        group[f'sum_{self._group_measure}'] = stats['sums'][value]
+                    top.append(group)
+                columns[column] = {'count': stats['count'], 'nulls': stats['nulls'],
+                                   'distinct_seen': len(stats['counts']), 'top_values': top}
+                if stats['truncated']:
+                    columns[column]['distinct_capped_at'] = self.max_groups
+        sample = [{column: self._clip(row.get(column), value_chars) for column in kept}
+                  for row in self._sample[:sample_rows]]
+        payload = {
+            'row_count': self.row_count,
+            'columns': columns,
+            'sample_rows': sample,
+        }
+        if len(kept) < len(self.columns):
+            payload['columns_omitted'] = len(self.columns) - len(kept)
+        return payload
+
+
+def compact_results(sql_results, budget_bytes=16000):
+    """
+    Returns the results unchanged when they fit in `budget_bytes`, otherwise their summary.
+
+    Returns:
+        - (payload, compacted)
+    """
+    summarizer = ResultSummarizer(budget_bytes=budget_bytes)
+    summarizer.add_rows(sql_results)
+    return summarizer.finish()
+
+
+def format_results_for_prompt(payload, compacted):
+    """Text of the results section of the answer prompt"""
+    if not compacted:
+        return f"{payload}"
+    return ("(too many rows to list, summary of all "
+            f"{payload['row_count']} rows with a random sample)\n"
+            + json.dumps(payload, default=str))
@@ -0,0 +1,207 @@
+import logging
+import math
+import sqlite3
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+#columns summed into the rollups, the ones a cost table has
+COST_MEASURES = ('billedcost', 'effectivecost', 'listcost', 'contractedcost', 'consumedquantity')
+#grain of the rollups, the ones a cost table has: day x service x region x account
+DAY_COLUMNS = ('chargeperiodstart_day', 'usagestartdate_day', 'date_day')
+DIMENSIONS = ('servicename', 'regionname', 'billingaccountid', 'subaccountid')
+#billing periods only ever get appended, refreshes only aggregate the periods past the last one rolled up
+PERIOD_COLUMNS = ('billingperiodstart',)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class RollupManager:
+    """
+    Maintains one pre-aggregated rollup table per cost table: SUM of every cost measure and the
+    source row count at the daily x service x region x account grain (whichever of those columns the
+    table has), e.g. `rollup_aws_cost_usage`.
+
+    Refreshes are incremental on the billing period: the rollup carries the period column and the
+    catalog records the last period rolled up (the watermark). When the source rows up to the
+    watermark still add up to what the rollup holds, only the newer periods are aggregated and
+    appended, anything else rebuilds the rollup (into a staging table swapped in like an ingest).
+
+    Every rollup is registered in the catalog, which is how the schema context learns about it.
+    """
+    def __init__(self, db_path='cloud_costs.db', catalog=None, result_cache=None, measures=COST_MEASURES,
+                 dimensions=DIMENSIONS, day_columns=DAY_COLUMNS, period_columns=PERIOD_COLUMNS):
+        self.db_path = db_path
+        self.catalog = catalog
+        self.result_cache = result_cache
+        self.measures = measures
+        self.dimensions = dimensions
+        self.day_columns = day_columns
+        self.period_columns = period_columns
+
+    @staticmethod
+    def rollup_name(table_name):
+        return f"rollup_{table_name}"
+
+    def definition(self, columns):
+        """
+        Rollup definition for a table with these columns.
+
+        Returns:
+            - {day, period, dimensions, measures}, or None when the table has no cost measure or no grain column
+        """
+        columns = set(columns)
+        measures = [column for column in self.measures if column in columns]
+        day = next((column for column in self.day_columns if column in columns), None)
+        period = next((column for column in self.period_columns if column in columns), None)
+        dimensions = [column for column in self.dimensions if column in columns]
+        if not measures or not (day or dimensions):
+            return None
+        return {'day': day, 'period': period, 'dimensions': dimensions, 'measures': measures}
+
+    @staticmethod
+    def grain(definition):
+        """Group-by columns of a rollup"""
+        return [column for column in [definition['day'], definition['period']] if column] + definition['dimensions']
+
+    #------ refresh ------
+    def refresh(self, tables):
+        """
+        Refreshes the rollup of each table that is a cost table.
+
+        Args:
+            - tables: source table names, e.g. the tables an ingest just rewrote
+
+        Returns:
+            - {table: {rollup, mode: 'full'|'incremental'|'unchanged', rows, watermark}} for every table with a rollup
+        """
+        report = {}
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            for table_name in tables:
+                try:
+                    result = self._refresh_table(conn, table_name)
+                except sqlite3.Error as e:
+                    logger.error(f"Rollup refresh failed for {table_name}: {e}")
+                    result = {'rollup': self.rollup_name(table_name), 'mode': 'failed', 'error': str(e)}
+                if result is not None:
+                    report[table_name] = result
+        finally:
+            conn.close()
+        return report
+
+    def _refresh_table(self, conn, table_name):
+        rollup = self.rollup_name(table_name)
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({_quote(table_name)})")]
+        definition = self.definition(columns)
+        registered = (self.catalog.rollups() if self.catalog else {}).get(rollup)
+        if definition is None:
+            if registered is not None:
+                #the table no longer looks like a cost table
+                with self._transaction(conn):
+                    conn.execute(f"DROP TABLE IF EXISTS {_quote(rollup)}")
+                self.catalog.delete_rollup(rollup)
+                self._invalidate(rollup)
+            return None
+
+        exists = bool(conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (rollup,)).fetchone())
+        period = definition['period']
+        mode = 'full'
+        watermark = registered['watermark'] if registered else None
+        if (exists and registered and registered['definition'] == definition and period and watermark is not None
+                and self._consistent(conn, table_name, rollup, definition, watermark)):
+            mode = 'incremental'
+
+        if mode == 'incremental':
+            with self._transaction(conn):
+                added = self._aggregate_into(conn, table_name, rollup, definition, after=watermark)
+            if not added:
+                mode = 'unchanged'
+        else:
+            self._rebuild(conn, table_name, rollup, definition)
+
+        if period:
+            watermark = conn.execute(f"SELECT MAX({_quote(period)}) FROM {_quote(rollup)}").fetchone()[0]
+        row_count = conn.execute(f"SELECT COUNT(*) FROM {_quote(rollup)}").fetchone()[0]
+        if self.catalog is not None:
+            self.catalog.put_rollup(rollup, table_name, definition, row_count, watermark)
+        if mode != 'unchanged':
+            self._invalidate(rollup)
+        logger.info(f"Rollup {rollup}: {mode} refresh, {row_count} rows")
+        return {'rollup': rollup, 'mode': mode, 'rows': row_count, 'watermark': watermark}
+
+    def _consistent(self, conn, table_name, rollup, definition, watermark):
+        """True when the source rows up to the watermark still add up to the rollup"""
+        period = _quote(definition['period'])
+        sums = ', '.join(f"SUM({_quote(column)})" for column in definition['measures'])
+        where = f"WHERE {period} <= ? OR {period} IS NULL"
+        source = conn.execute(f"SELECT COUNT(*), {sums} FROM {_quote(table_name)} {where}", (watermark,)).fetchone()
+        rolled = conn.execute(f"SELECT SUM(row_count), {sums} FROM {_quote(rollup)} {where}", (watermark,)).fetchone()
+        if (source[0] or 0) != (rolled[0] or 0):
+            return False
+        return all(math.isclose(a or 0, b or 0, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(source[1:], rolled[1:]))
+
+    def _aggregate_into(self, conn, table_name, target, definition, after=None):
+        """Appends the aggregated source rows (only the periods after `after` when given), returns the rows added"""
+        grain = ', '.join(_quote(column) for column in self.grain(definition))
+        sums = ', '.join(f"SUM({_quote(column)})" for column in definition['measures'])
+        where, params = "", ()
+        if after is not None:
+            where, params = f"WHERE {_quote(definition['period'])} > ?", (after,)
+        cursor = conn.execute(f"""INSERT INTO {_quote(target)} SELECT {grain}, {sums}, COUNT(*)
+                                  FROM {_quote(table_name)} {where} GROUP BY {grain}""", params)
+        return cursor.rowcount
+
+    def _rebuild(self, conn, table_name, rollup, definition):
+        """Aggregates the whole table into a staging table and swaps it in for the rollup"""
+        staging = f"{rollup}__staging"
+        source_types = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({_quote(table_name)})")}
+        column_sql = [f"{_quote(column)} {source_types.get(column) or ''}".strip() for column in self.grain(definition)]
+        column_sql += [f"{_quote(column)} REAL" for column in definition['measures']] + ['"row_count" INTEGER']
+        with self._transaction(conn):
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+            conn.execute(f"CREATE TABLE {_quote(staging)} ({', '.join(column_sql)})")
+            self._aggregate_into(conn, table_name, staging, definition)
+        with self._transaction(conn):
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(rollup)}")
+            conn.execute(f"ALTER TABLE {_quote(staging)} RENAME TO {_quote(rollup)}")
+            #time-bucketed questions filter on the day/period first
+            lead = definition['day'] or definition['period']
+            if lead:
+                conn.execute(f"CREATE INDEX {_quote(f'idx_{rollup}_{lead}')} ON {_quote(rollup)} ({_quote(lead)})")
+            if definition['period'] and definition['period'] != lead:
+                conn.execute(f"""CREATE INDEX {_quote(f"idx_{rollup}_{definition['period']}")}
+                                 ON {_quote(rollup)} ({_quote(definition['period'])})""")
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn):
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _invalidate(self, rollup):
+        #cached query results over the old rollup are stale now
+        if self.result_cache is not None:
+            self.result_cache.invalidate_table(rollup)
+
+
+def rollup_hint(rollup_name, entry):
+    """Schema context lines telling the llm when to read a rollup instead of its source table"""
+    definition = entry['definition']
+    grain = RollupManager.grain(definition)
+    measures = ', '.join(f"{column} (SUM)" for column in definition['measures'])
+    month = f" (or coarser, e.g. month = substr({definition['day']}, 1, 7))" if definition['day'] else ""
+    return (f"\nRollup: {rollup_name}\nRows: {entry['row_count']}\n"
+            f"  Pre-aggregated {entry['source_table']}, one row per {', '.join(grain)}.\n"
+            f"  Columns: {', '.join(grain)}, {measures}, row_count (source rows)\n"
+            f"  Prefer {rollup_name} over {entry['source_table']} when the question only filters and groups on "
+            f"these columns{month}; SUM the measures again, COUNT(*) is SUM(row_count).\n")
@@ -0,0 +1,130 @@
+import threading
+
+from schema_retrieval import SchemaIndex, estimate_tokens
+from rollups import rollup_hint
+
+
+def build_profile_map(all_profiles):
+    """
+    Reduces the complete profiles to what the text2sql prompt needs.
+
+    Args:
+        - all_profiles: the complete profile dict ({table: {row_count, columns}})
+
+    Returns:
+        - profile map with only the short descriptions for each column
+    """
+    profile_map = {}
+    for table in all_profiles.keys():
+        profile_map[table] = {
+            'row_count': all_profiles[table]['row_count'],
+            'columns': {col: {
+                'data_type': data['data_type'],
+                'sample_values': data['sample_values'][:2],
+                'short_description': data['short_description']
+                # 'long_description':data['long_description'],
+            } for col, data in all_profiles[table]['columns'].items()}
+        }
+    return profile_map
+
+
+def render_schema_context(profile_map, rollups=None):
+    """Renders the profile map (and the rollups of its tables) into the schema section of the text2sql prompt."""
+    parts = []
+    for table_name, profile in profile_map.items():
+        parts.append(f"\nTable: {table_name}\nRows: {profile['row_count']}\n")
+        for col_name, col_data in profile['columns'].items():
+            parts.append(f"  - {col_name}: {col_data['short_description']}\n")
+    for rollup_name, entry in (rollups or {}).items():
+        if entry['source_table'] in profile_map:
+            parts.append(rollup_hint(rollup_name, entry))
+    return ''.join(parts)
+
+
+class SchemaContext:
+    """
+    One immutable build of the schema context.
+
+    `prompt_prefix` is everything in the text2sql prompt up to the user query,
+    so handling a request only has to append the query and the fixed suffix.
+    With `top_k_tables`/`top_k_columns` set, the prompt only carries the tables and
+    columns a BM25 index over the schema finds relevant to the query.
+    The rollups of the tables in the prompt are listed after them, with when to prefer them.
+    `dialect_hint` tells the llm which sql engine runs the query.
+    """
+    PROMPT_SUFFIX = '"\n\nReturn ONLY SQL:'
+
+    def __init__(self, version, profile_map, top_k_tables=0, top_k_columns=0, rollups=None, dialect_hint=None):
+        self.version = version
+        self.profile_map = profile_map
+        self.top_k_tables = top_k_tables
+        self.top_k_columns = top_k_columns
+        self.rollups = rollups or {}
+        self.dialect_prefix = f"SQL dialect: {dialect_hint}\n\n" if dialect_hint else ''
+        self.schema_context = render_schema_context(profile_map, self.rollups)
+        self.prompt_prefix = f'{self.dialect_prefix}Database Schema:\n{self.schema_context}\n\nQuery: "'
+        self.full_prompt_tokens = estimate_tokens(self.prompt_prefix + self.PROMPT_SUFFIX)
+        self._index = None
+
+    @property
+    def pruning(self):
+        return bool(self.top_k_tables or self.top_k_columns)
+
+    @property
+    def index(self) -> SchemaIndex:
+        """BM25 index over this schema, built on first use"""
+        if self._index is None:
+            self._index = SchemaIndex(self.profile_map)
+        return self._index
+
+    def select(self, user_query):
+        """Returns the pruned profile map for `user_query`"""
+        selection = self.index.select(user_query, self.top_k_tables, self.top_k_columns)
+        return {
+            table: {'row_count': self.profile_map[table]['row_count'],
+                    'columns': {col: self.profile_map[table]['columns'][col] for col in columns}}
+            for table, columns in selection.items()
+        }
+
+    def build_prompt(self, user_query):
+        """Returns the full text2sql prompt for `user_query`."""
+        if not self.pruning:
+            return self.prompt_prefix + user_query + self.PROMPT_SUFFIX
+        schema_context = render_schema_context(self.select(user_query), self.rollups)
+        return f'{self.dialect_prefix}Database Schema:\n{schema_context}\n\nQuery: "' + user_query + self.PROMPT_SUFFIX
+
+
+class SchemaContextCache:
+    """
+    Keeps the schema context built from the catalog's published profiles in memory.
+
+    Each `get()` only reads the catalog's version (one indexed row); the profiles are
+    re-read and the context rebuilt only when that version changed. With a `dialect` the
+    schema version is qualified by it, so sql generated for another engine is never reused.
+    """
+    def __init__(self, catalog, top_k_tables=0, top_k_columns=0, dialect=None, dialect_hint=None):
+        self.catalog = catalog
+        self.top_k_tables = top_k_tables
+        self.top_k_columns = top_k_columns
+        self.dialect = dialect
+        self.dialect_hint = dialect_hint
+        self._lock = threading.Lock()
+        self._context = None
+
+    def get(self) -> SchemaContext:
+        """Returns the current schema context, rebuilding it only if the profiles changed."""
+        version = self._qualified(self.catalog.version())
+        with self._lock:
+            if self._context is None or self._context.version != version:
+                version, profiles, rollups = self.catalog.published_snapshot()
+                self._context = SchemaContext(self._qualified(version), build_profile_map(profiles),
+                                              self.top_k_tables, self.top_k_columns, rollups, self.dialect_hint)
+            return self._context
+
+    def _qualified(self, version):
+        return f"{version}-{self.dialect}" if self.dialect else version
+
+    @property
+    def version(self):
+        """The schema version of the current profiles."""
+        return self.get().version
@@ -0,0 +1,234 @@
+import json
+import math
+import re
+from collections import Counter, defaultdict
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def _stem(word):
+    """Very light stemming so 'costs'/'cost' and 'services'/'service' match"""
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Lowercased, lightly stemmed word tokens (underscores split words)"""
+    return [_stem(word) for word in _WORD.findall(str(text).lower().replace('_', ' '))]
+
+
+#cost-analytics wording that never appears in the column descriptions
+QUERY_SYNONYMS = {
+    'spend': ['cost'],
+    'spent': ['cost'],
+    'expense': ['cost'],
+    'price': ['cost'],
+    'daily': ['day', 'date', 'period'],
+    'monthly': ['month', 'period', 'billing'],
+    'month': ['period', 'billing'],
+    'trend': ['date', 'period'],
+    'subscription': ['subaccount', 'account'],
+    'instance': ['resource', 'sku'],
+    'usage': ['quantity', 'consumed'],
+}
+
+
+def expand_query(query):
+    """Query tokens plus their domain synonyms"""
+    tokens = tokenize(query)
+    return tokens + [synonym for token in tokens for synonym in QUERY_SYNONYMS.get(token, [])]
+
+
+def estimate_tokens(text):
+    """Rough llm token count (~4 characters per token)"""
+    return max(1, len(text) // 4)
+
+
+class SchemaIndex:
+    """
+    BM25 index over the schema, one document per column.
+
+    A column's document is its table name, its column name and its short description. Column names
+    in the cost tables are concatenated words ('billedcost', 'servicename'), so they are also split
+    into the description vocabulary words they contain, letting 'service name' match 'servicename'.
+    """
+    def __init__(self, profile_map, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.table_columns = {table: list(profile['columns'].keys()) for table, profile in profile_map.items()}
+
+        raw_docs = []
+        vocabulary = set()
+        for table, profile in profile_map.items():
+            for col_name, col_data in profile['columns'].items():
+                description_tokens = tokenize(col_data.get('short_description', ''))
+                vocabulary.update(token for token in description_tokens if len(token) >= 4)
+                raw_docs.append((table, col_name, tokenize(table) + tokenize(col_name) + description_tokens))
+        for table in profile_map:
+            vocabulary.update(token for token in tokenize(table) if len(token) >= 4)
+
+        self.docs = []
+        self.postings = defaultdict(list) #token -> [(doc id, term frequency)]
+        total_length = 0
+        for doc_id, (table, col_name, tokens) in enumerate(raw_docs):
+            tokens = tokens + self._split_compound(col_name, vocabulary)
+            counts = Counter(tokens)
+            for token, tf in counts.items():
+                self.postings[token].append((doc_id, tf))
+            self.docs.append((table, col_name, len(tokens)))
+            total_length += len(tokens)
+        self.avg_length = total_length / len(self.docs) if self.docs else 0.0
+
+        #one more document per table (name + every column document) to rank whole tables
+        self.table_docs = {}
+        self.table_postings = defaultdict(list)
+        for table, _, tokens in raw_docs:
+            self.table_docs.setdefault(table, tokenize(table) * 3)
+            self.table_docs[table].extend(tokens)
+        for table, tokens in self.table_docs.items():
+            for token, tf in Counter(tokens).items():
+                self.table_postings[token].append((table, tf))
+        self.avg_table_length = (sum(len(t) for t in self.table_docs.values()) / len(self.table_docs)
+                                 if self.table_docs else 0.0)
+
+    @staticmethod
+    def _split_compound(name, vocabulary):
+        """Vocabulary words contained in a concatenated identifier"""
+        compact = name.lower().replace('_', '')
+        return [word for word in vocabulary if word in compact and word != compact]
+
+    def _bm25(self, query_tokens, postings, lengths, avg_length):
+        scores = defaultdict(float)
+        n_docs = len(lengths)
+        for token in set(query_tokens):
+            matches = postings.get(token)
+            if not matches:
+                continue
+            idf = math.log(1 + (n_docs - len(matches) + 0.5) / (len(matches) + 0.5))
+            for doc, tf in matches:
+                norm = tf + self.k1 * (1 - self.b + self.b * lengths[doc] / avg_length)
+                scores[doc] += idf * tf * (self.k1 + 1) / norm
+        return scores
+
+    def score_columns(self, query):
+        """BM25 score of every column that shares a token with the query"""
+        lengths = [length for _, _, length in self.docs]
+        scores = self._bm25(expand_query(query), self.postings, lengths, self.avg_length)
+        return {(self.docs[doc_id][0], self.docs[doc_id][1]): score for doc_id, score in scores.items()}
+
+    def score_tables(self, query):
+        """BM25 score of every table document"""
+        lengths = {table: len(tokens) for table, tokens in self.table_docs.items()}
+        return self._bm25(expand_query(query), self.table_postings, lengths, self.avg_table_length)
+
+    def select(self, query, top_k_tables=3, top_k_columns=30):
+        """
+        Picks the tables and columns relevant to `query`.
+
+        Tables are ranked by their own BM25 score plus their best column score. Each selected table keeps
+        its `top_k_columns` best scoring columns, in their original order.
+
+        Returns:
+            - {table: [columns]} in schema order
+        """
+        column_scores = self.score_columns(query)
+        table_scores = self.score_tables(query)
+        for table, columns in self.table_columns.items():
+            table_scores[table] += max((column_scores.get((table, col), 0.0) for col in columns), default=0.0)
+
+        ranked = sorted(self.table_columns, key=lambda table: -table_scores[table])
+        chosen = set(ranked[:top_k_tables]) if top_k_tables else set(ranked)
+
+        selection = {}
+        for table, columns in self.table_columns.items():
+            if table not in chosen:
+                continue
+            if not top_k_columns or len(columns) <= top_k_columns:
+                selection[table] = list(columns)
+                continue
+            order = sorted(range(len(columns)), key=lambda i: (-column_scores.get((table, columns[i]), 0.0), i))
+            keep = set(order[:top_k_columns])
+            selection[table] = [col for i, col in enumerate(columns) if i in keep]
+        return selection
+
+
+def evaluate(index, cases, render, full_context, top_k_tables=3, top_k_columns=30):
+    """
+    Measures column recall and prompt savings of `index.select` on a set of test questions.
+
+    Args:
+        - cases: list of {"query": ..., "expected": {table: [columns]}}
+        - render: function turning a selection into schema context text
+        - full_context: the unpruned schema context text
+
+    Returns:
+        - dict with per-case results and averages
+    """
+    full_tokens = estimate_tokens(full_context)
+    results = []
+    for case in cases:
+        selection = index.select(case['query'], top_k_tables, top_k_columns)
+        expected = [(table, col) for table, cols in case['expected'].items() for col in cols]
+        found = [pair for pair in expected if pair[1] in selection.get(pair[0], [])]
+        pruned_tokens = estimate_tokens(render(selection))
+        results.append({
+            'query': case['query'],
+            'recall': len(found) / len(expected) if expected else 1.0,
+            'missing': [f"{table}.{col}" for table, col in expected if (table, col) not in found],
+            'prompt_tokens': pruned_tokens,
+            'token_savings': 1 - pruned_tokens / full_tokens,
+        })
+    n = len(results) or 1
+    return {
+        'full_prompt_tokens': full_tokens,
+        'mean_recall': sum(r['recall'] for r in results) / n,
+        'mean_token_savings': sum(r['token_savings'] for r in results) / n,
+        'cases': results,
+    }
+
+
+#small labelled test set over the cost tables (the columns a correct query needs)
+TEST_CASES = [
+    {"query": "Show me the total compute cost for Azure grouped by service.",
+     "expected": {"azure_cost_usage": ["billedcost", "servicename", "servicecategory"]}},
+    {"query": "Which AWS region had the highest spend last month?",
+     "expected": {"aws_cost_usage": ["regionname", "billedcost", "chargeperiodstart"]}},
+    {"query": "What is the daily trend of S3 storage cost?",
+     "expected": {"aws_cost_usage": ["servicename", "billedcost", "chargeperiodstart"]}},
+    {"query": "What is EC2 usage by instance type?",
+     "expected": {"aws_cost_usage": ["servicename", "consumedquantity", "resourcetype"]}},
+    {"query": "Whats the mean value of billed cost for the data",
+     "expected": {"aws_cost_usage": ["billedcost"]}},
+    {"query": "What are all the distinct service names",
+     "expected": {"Services": ["servicename"]}},
+    {"query": "Effective cost per Azure subscription",
+     "expected": {"azure_cost_usage": ["effectivecost", "subaccountname"]}},
+]
+
+
+if __name__ == "__main__":
+    from schema_context import build_profile_map, render_schema_context
+
+    #the described cost tables plus whatever the current complete profile holds
+    all_profiles = {}
+    for profile_file in ['all_profiles.json', 'complete_profiles.json']:
+        with open(profile_file, 'r') as f:
+            all_profiles.update(json.load(f))
+    profile_map = build_profile_map(all_profiles)
+    index = SchemaIndex(profile_map)
+
+    def render(selection):
+        return render_schema_context({
+            table: {'row_count': profile_map[table]['row_count'],
+                    'columns': {col: profile_map[table]['columns'][col] for col in cols}}
+            for table, cols in selection.items()
+        })
+
+    cases = [case for case in TEST_CASES if all(table in profile_map for table in case['expected'])]
+    report = evaluate(index, cases, render, render_schema_context(profile_map), top_k_tables=2, top_k_columns=20)
+    for result in report['cases']:
+        print(f"{result['recall']:.2f} recall, {result['token_savings']:.0%} fewer tokens: {result['query']}"
+              + (f" (missing {result['missing']})" if result['missing'] else ""))
+    print(f"Full schema prompt: {report['full_prompt_tokens']} tokens")
+    print(f"Mean recall: {report['mean_recall']:.2f}, mean token savings: {report['mean_token_savings']:.0%}")
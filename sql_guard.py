@@ -0,0 +1,248 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from sql_utils import has_limit, sql_words, strip_trailing_comments, table_aliases
+
+#statements the llm sql may never contain, e.g. WITH ... DELETE (REPLACE only as a statement, replace() is a string function)
+WRITE_KEYWORDS = {'insert', 'update', 'delete', 'drop', 'alter', 'create', 'attach', 'detach', 'pragma',
+                  'vacuum', 'reindex', 'replace'}
+READ_STATEMENTS = {'select', 'with', 'values'}
+#sqlite authorizer actions a read-only query needs
+READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+class QueryRejected(Exception):
+    """The query was not run: it isn't read-only or its plan is too expensive"""
+    status_code = 400
+
+    def __init__(self, reason, detail):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+
+    def to_dict(self):
+        return {'error': 'query_rejected', 'reason': self.reason, 'detail': self.detail}
+
+
+class QueryTimeout(Exception):
+    """The query ran past its deadline and was interrupted"""
+    status_code = 408
+
+    def __init__(self, seconds):
+        super().__init__(f"Query exceeded the {seconds}s deadline")
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {'error': 'query_timeout', 'detail': str(self), 'timeout_seconds': self.seconds}
+
+
+class Deadline:
+    """
+    Time budget of one query that only runs between `start()` and `stop()`, i.e. while the engine works
+    on the query, so a stream's reader can take its time between fetches. With `on_expire` a timer calls
+    it once the budget is used up, without it the budget is polled through `passed()`.
+    """
+    def __init__(self, seconds, on_expire=None):
+        self.seconds = seconds
+        self.remaining = seconds
+        self.expired = False
+        self.on_expire = on_expire
+        self._started = None
+        self._timer = None
+
+    def start(self):
+        self._started = time.monotonic()
+        if self.on_expire is not None:
+            self._timer = threading.Timer(max(self.remaining, 0), self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._started is not None:
+            self.remaining -= time.monotonic() - self._started
+            self._started = None
+
+    @contextmanager
+    def running(self):
+        self.start()
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def passed(self):
+        if self._started is not None and time.monotonic() - self._started > self.remaining:
+            self.expired = True
+        return self.expired
+
+    def _expire(self):
+        self.expired = True
+        try:
+            self.on_expire()
+        except Exception:
+            pass
+
+
+class QueryGuard:
+    """
+    Guardrails around the generated sql.
+
+        - `prepare` rejects anything but a single read-only statement and appends `LIMIT max_rows`
+          when the query has no LIMIT of its own
+        - `check_plan` reads EXPLAIN QUERY PLAN and rejects nested full scans of tables (a cross join,
+          or a join on a condition no index can serve) whose row counts multiply past `max_cross_join_rows`
+        - `limits` (sqlite) runs the query under a read-only authorizer and a progress handler that
+          interrupts it after `timeout_seconds`, `duckdb_limits` interrupts a duckdb cursor the same way.
+          Streams keep a paused Deadline, only the time spent executing and fetching counts
+
+    Failures surface as QueryRejected / QueryTimeout.
+    """
+    def __init__(self, max_rows=10000, timeout_seconds=30.0, max_cross_join_rows=10_000_000, progress_ops=1000):
+        self.max_rows = max_rows
+        self.timeout_seconds = timeout_seconds
+        self.max_cross_join_rows = max_cross_join_rows
+        self.progress_ops = progress_ops
+
+    def prepare(self, sql, max_rows=None) -> str:
+        """
+        Args:
+            - sql: the generated query
+            - max_rows: row cap to inject, `self.max_rows` when None (0 disables it)
+
+        Returns:
+            - the query to run
+        """
+        #a trailing comment would swallow the LIMIT added below (an unterminated /* runs to the end)
+        statement = strip_trailing_comments(sql).strip().rstrip(';').strip()
+        words = sql_words(statement)
+        if not words:
+            raise QueryRejected('empty', "The query is empty")
+        if ';' in words:
+            raise QueryRejected('multiple_statements', "Only a single statement can be run")
+        if words[0] not in READ_STATEMENTS:
+            raise QueryRejected('not_read_only', f"{words[0].upper()} statements are not allowed, only SELECT")
+        for position, word in enumerate(words):
+            if word in WRITE_KEYWORDS and not (position + 1 < len(words) and words[position + 1] == '('):
+                raise QueryRejected('not_read_only', f"{word.upper()} is not allowed, only read-only queries run")
+
+        cap = self.max_rows if max_rows is None else max_rows
+        if cap and not has_limit(statement):
+            statement = f"{statement}\nLIMIT {int(cap)}"
+        return statement
+
+    #------ sqlite ------
+    def check_plan(self, conn, sql):
+        """Rejects the query when its plan nests full scans of large tables"""
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.Error as e:
+            if 'not authorized' in str(e):
+                raise QueryRejected('not_read_only', str(e)) from e
+            #a query that doesn't compile fails the same way when it runs
+            return
+        #the plan names tables by their alias
+        tables = table_aliases(sql, [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")])
+        scans = {}
+        for _, parent, _, detail in plan:
+            words = [word for word in detail.split() if word != 'TABLE']
+            name = words[1].strip('"').lower() if len(words) > 1 and words[0] == 'SCAN' else None
+            if name in tables:
+                scans.setdefault(parent, []).append(tables[name])
+        for scanned in scans.values():
+            if len(scanned) < 2:
+                continue
+            rows = 1
+            for table in scanned:
+                rows *= self._estimated_rows(conn, table)
+            if rows > self.max_cross_join_rows:
+                raise QueryRejected('cross_join', f"The query scans {', '.join(scanned)} in a nested loop "
+                                                  f"(~{rows:,} row combinations), join them on a key column")
+
+    @staticmethod
+    def _estimated_rows(conn, table):
+        #MAX(rowid) is an index lookup, COUNT(*) would scan the table
+        try:
+            return conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except sqlite3.Error:
+            return 0
+
+    @staticmethod
+    def _authorizer(action, *args):
+        return sqlite3.SQLITE_OK if action in READ_ACTIONS else sqlite3.SQLITE_DENY
+
+    def install(self, conn, deadline=None):
+        """
+        Puts the authorizer and the deadline on a sqlite connection.
+
+        Args:
+            - deadline: Deadline to enforce, a new one that starts running right away when None
+
+        Returns:
+            - function(exception) -> the QueryRejected/QueryTimeout the exception stands for, or the exception itself
+        """
+        if deadline is None:
+            deadline = Deadline(self.timeout_seconds)
+            deadline.start()
+
+        def progress():
+            return 1 if deadline.passed() else 0
+
+        conn.set_authorizer(self._authorizer)
+        conn.set_progress_handler(progress, self.progress_ops)
+
+        def translate(error):
+            if deadline.expired:
+                return QueryTimeout(self.timeout_seconds)
+            if 'not authorized' in str(error):
+                return QueryRejected('not_read_only', str(error))
+            return error
+        return translate
+
+    @staticmethod
+    def uninstall(conn):
+        conn.set_authorizer(None)
+        conn.set_progress_handler(None, 0)
+
+    @contextmanager
+    def limits(self, conn):
+        """Runs the block under the authorizer and the deadline"""
+        translate = self.install(conn)
+        try:
+            yield
+        except Exception as e:
+            error = translate(e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            self.uninstall(conn)
+
+    #------ duckdb ------
+    def start_deadline(self, cursor):
+        """
+        Interrupts a duckdb cursor once it has run for `timeout_seconds`.
+
+        Returns:
+            - (Deadline, function(exception) -> QueryTimeout or the exception itself), the deadline is
+              not running yet, wrap every call on the cursor in `deadline.running()`
+        """
+        deadline = Deadline(self.timeout_seconds, on_expire=cursor.interrupt)
+        return deadline, lambda error: QueryTimeout(self.timeout_seconds) if deadline.expired else error
+
+    @contextmanager
+    def duckdb_limits(self, cursor):
+        """Runs the block under the deadline"""
+        deadline, translate = self.start_deadline(cursor)
+        try:
+            with deadline.running():
+                yield
+        except Exception as e:
+            error = translate(e)
+            if error is e:
+                raise
+            raise error from e
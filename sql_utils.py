@@ -0,0 +1,233 @@
+import re
+
+#string literals are dropped before looking for identifiers so 'aws_cost_usage' in a filter doesn't count as a table
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_IDENTIFIER = re.compile(r'"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def sql_identifiers(sql: str):
+    """Returns every identifier (bare or quoted) that appears in `sql`, outside string literals."""
+    identifiers = []
+    for match in _IDENTIFIER.finditer(_STRING_LITERAL.sub(' ', sql)):
+        identifiers.append(next(group for group in match.groups() if group is not None))
+    return identifiers
+
+
+def referenced_tables(sql: str, known_tables) -> list:
+    """
+    Returns the known tables that `sql` references.
+
+    Any identifier matching a known table name counts, so the result may over-approximate
+    (e.g. a column named like a table) but never misses a table the query reads.
+    """
+    by_lower = {table.lower(): table for table in known_tables}
+    found = {by_lower[name.lower()] for name in sql_identifiers(sql) if name.lower() in by_lower}
+    return sorted(found)
+
+
+#------ tokens ------
+#literals, comments and code in one pass, so a -- inside a literal or a ' inside a comment is read the way sqlite reads it
+#(an unterminated /* comment runs to the end, a bracket never spans a ; )
+_SQL_TOKEN = re.compile(r"""('(?:[^']|'')*')|(--[^\n]*|/\*.*?(?:\*/|\Z))|"""
+                        r'("(?:[^"]|"")*"|`[^`]*`|\[[^\];]*\]|[A-Za-z_][A-Za-z0-9_]*|\d+(?:\.\d+)?|<=|>=|<>|!=|==|\S)',
+                        re.DOTALL)
+
+
+def sql_tokens(sql: str, literal=None):
+    """
+    Code tokens of `sql`, comments dropped.
+
+    Args:
+        - sql
+        - literal: token standing in for each string literal, literals are dropped when None
+    """
+    tokens = []
+    for string, comment, token in _SQL_TOKEN.findall(sql):
+        if string:
+            if literal is not None:
+                tokens.append(literal)
+        elif token:
+            tokens.append(token)
+    return tokens
+
+
+def strip_trailing_comments(sql: str) -> str:
+    """`sql` up to the end of its last literal or code token, the comments after it removed"""
+    end = 0
+    for match in _SQL_TOKEN.finditer(sql):
+        if not match.group(2):
+            end = match.end()
+    return sql[:end]
+
+
+#------ column usage (for the index advisor) ------
+_CLAUSES = {'select', 'from', 'join', 'on', 'where', 'group', 'having', 'order', 'limit', 'union', 'using', 'window'}
+_KEYWORDS = _CLAUSES | {
+    'as', 'and', 'or', 'not', 'in', 'is', 'null', 'between', 'like', 'glob', 'by', 'asc', 'desc', 'distinct',
+    'case', 'when', 'then', 'else', 'end', 'inner', 'left', 'right', 'outer', 'cross', 'natural', 'full',
+    'exists', 'all', 'with', 'offset', 'escape', 'cast', 'true', 'false', 'intersect', 'except',
+}
+EQUALITY_OPERATORS = {'=', '==', 'in', 'is'}
+RANGE_OPERATORS = {'<', '>', '<=', '>=', 'between', 'like', 'glob'}
+
+
+def _unquote(token):
+    if token[0] in '"`[':
+        return token[1:-1]
+    return token
+
+
+def query_column_usage(sql: str, table_columns: dict):
+    """
+    Finds the columns a query filters, joins and groups on.
+
+    Args:
+        - sql
+        - table_columns: {table_name: [column names]} of the database
+
+    Returns:
+        - list of (table, column, kind) in query order, kind is "eq" or "range" (WHERE/HAVING
+          comparisons), "join" (ON conditions) or "group" (GROUP BY). Columns wrapped in functions
+          are skipped since an index can't serve them.
+    """
+    tables = {name.lower(): name for name in table_columns}
+    columns = {name.lower(): {column.lower(): column for column in cols} for name, cols in table_columns.items()}
+    tokens = sql_tokens(sql, literal='?')
+
+    #merge qualified names (a . b) into one token
+    merged = []
+    for token in tokens:
+        if len(merged) >= 2 and merged[-1] == '.' and token != '.':
+            merged[-2:] = [merged[-2] + '.' + token]
+        else:
+            merged.append(token)
+    tokens = merged
+    lowered = [_unquote(token).lower() if token[0] in '"`[' else token.lower() for token in tokens]
+
+    aliases = {}  #alias/table name -> table
+    #every SELECT is a scope: its FROM tables, and the scope it is nested in (a column resolves in the innermost scope that has it)
+    scope_tables = {0: []}
+    scope_parent = {0: None}
+    references = []  #(qualifier, column, kind, scope)
+    #per parenthesis level: [clause, scope, scope enclosing the level]
+    frames = [['select', 0, None]]
+    pending_table = None
+
+    def is_identifier(i):
+        token = tokens[i]
+        return (token[0] in '"`[' or re.match(r'[A-Za-z_]', token)) and lowered[i] not in _KEYWORDS
+
+    for i, token in enumerate(tokens):
+        word = lowered[i]
+        clause, scope = frames[-1][0], frames[-1][1]
+        if token == '(':
+            frames.append([clause, scope, scope])
+            continue
+        if token == ')':
+            if len(frames) > 1:
+                frames.pop()
+            continue
+        if word in _CLAUSES:
+            frames[-1][0] = word
+            pending_table = None
+            if word == 'select':
+                #a subquery, or the next SELECT of a UNION at the same level
+                scope = len(scope_tables)
+                scope_tables[scope] = []
+                scope_parent[scope] = frames[-1][2]
+                frames[-1][1] = scope
+            continue
+
+        if clause in ('from', 'join'):
+            if is_identifier(i) and '.' not in word:
+                name = _unquote(token).lower()
+                if pending_table is None and name in tables:
+                    pending_table = tables[name]
+                    scope_tables[scope].append(pending_table)
+                    aliases[name] = pending_table
+                elif pending_table is not None:
+                    aliases[name] = pending_table
+                    pending_table = None
+            elif token == ',':
+                pending_table = None
+            continue
+
+        if clause not in ('where', 'having', 'on', 'group') or not is_identifier(i):
+            continue
+        if i + 1 < len(tokens) and tokens[i + 1] == '(':
+            continue  #a function name
+        previous = lowered[i - 1] if i else ''
+        following = lowered[i + 1] if i + 1 < len(tokens) else ''
+        if following == 'not' and i + 2 < len(tokens):
+            following = lowered[i + 2]
+        kind = None
+        if clause == 'group':
+            if previous in ('by', ','):
+                kind = 'group'
+        elif clause == 'on':
+            if following in EQUALITY_OPERATORS or previous in EQUALITY_OPERATORS:
+                kind = 'join'
+        elif following in EQUALITY_OPERATORS:
+            kind = 'eq'
+        elif following in RANGE_OPERATORS:
+            kind = 'range'
+        elif previous in RANGE_OPERATORS | EQUALITY_OPERATORS and previous not in ('between', 'like', 'glob'):
+            #value <op> column
+            kind = 'eq' if previous in EQUALITY_OPERATORS else 'range'
+        if kind is None:
+            continue
+        qualifier, _, column = word.rpartition('.')
+        references.append((qualifier, _unquote(column) if column[0] in '"`[' else column, kind, scope))
+
+    usage = []
+    for qualifier, column, kind, scope in references:
+        if qualifier:
+            table = aliases.get(_unquote(qualifier))
+            candidates = [table] if table else []
+        else:
+            candidates = []
+            while scope is not None:
+                candidates += scope_tables[scope]
+                scope = scope_parent[scope]
+        for table in candidates:
+            if column in columns.get(table.lower(), {}):
+                entry = (table, columns[table.lower()][column], kind)
+                if entry not in usage:
+                    usage.append(entry)
+                break
+    return usage
+
+
+#------ statement shape (for the query guard) ------
+def sql_words(sql: str):
+    """Lowercased keywords/identifiers and ( ) ; of `sql`, outside comments and string literals, quoted identifiers dropped"""
+    return [token.lower() for token in sql_tokens(sql) if token in '();' or re.match(r'[A-Za-z_]', token)]
+
+
+def has_limit(sql: str) -> bool:
+    """True when the outermost statement has its own LIMIT"""
+    depth = 0
+    for word in sql_words(sql):
+        if word == '(':
+            depth += 1
+        elif word == ')':
+            depth -= 1
+        elif word == 'limit' and depth == 0:
+            return True
+    return False
+
+
+def table_aliases(sql: str, known_tables) -> dict:
+    """{table name or alias (lowercase): table} for the known tables `sql` reads, e.g. FROM big AS b"""
+    tables = {name.lower(): name for name in known_tables}
+    tokens = sql_tokens(sql)
+    lowered = [_unquote(token).lower() for token in tokens]
+    aliases = {}
+    for i, word in enumerate(lowered):
+        if word not in tables or (i + 1 < len(tokens) and tokens[i + 1] == '.'):
+            continue
+        aliases[word] = tables[word]
+        j = i + 2 if i + 1 < len(tokens) and lowered[i + 1] == 'as' else i + 1
+        if j < len(tokens) and (tokens[j][0] in '"`[' or re.match(r'[A-Za-z_]', tokens[j])) and lowered[j] not in _KEYWORDS:
+            aliases[lowered[j]] = tables[word]
+    return aliases
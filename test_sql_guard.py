@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+from sql_guard import QueryGuard, QueryRejected
+from sql_utils import has_limit, sql_words
+
+
+def test_comment_marker_inside_literal_does_not_hide_statements():
+    sql = "SELECT '--'; COPY (SELECT 42 AS x) TO '/tmp/rvw/pwn.csv'; SELECT 1 AS y"
+    assert 'copy' in sql_words(sql)
+    with pytest.raises(QueryRejected) as rejected:
+        QueryGuard().prepare(sql)
+    assert rejected.value.reason == 'multiple_statements'
+
+
+def test_comment_marker_inside_literal_keeps_the_limit():
+    sql = "SELECT * FROM t WHERE x = '--' LIMIT 5"
+    assert has_limit(sql)
+    prepared = QueryGuard().prepare(sql)
+    assert prepared == sql
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (x TEXT)")
+    conn.execute("INSERT INTO t VALUES ('--')")
+    assert conn.execute(prepared).fetchall() == [('--',)]
+
+
+def test_quote_inside_comment_is_not_a_literal():
+    sql = "SELECT 1 -- it's\n; DELETE FROM t"
+    with pytest.raises(QueryRejected):
+        QueryGuard().prepare(sql)
+
+
+def test_unterminated_block_comment_does_not_swallow_the_limit():
+    prepared = QueryGuard(max_rows=5).prepare("SELECT * FROM t /* trailing")
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(100)])
+    assert len(conn.execute(prepared).fetchall()) == 5
+    assert len(conn.execute(QueryGuard(max_rows=5).prepare("SELECT * FROM t; -- done")).fetchall()) == 5